@@ -0,0 +1,184 @@
+# Scaling benchmarks of the standard depthmapXcli pipelines on the bundled
+# datasets, to tell whether a new binary in lib/ or a change to the wrappers
+# in commonFunctions made things faster or slower. Run from this folder:
+#
+#   python benchmarkPipelines.py --save-baseline    # record a baseline
+#   python benchmarkPipelines.py                    # compare against it
+#
+# Every case records the wall time of the whole pipeline, the time spent in
+# the cli, the peak RSS of the largest cli run and the time taken to load the
+# results back into python. A case regresses when its wall time, peak RSS or
+# loading time grows by more than the tolerance over the baseline. The barnsbury_axial
+# series takes minutes per repeat, use --series to run a subset.
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(1, os.path.join(sys.path[0], '../commonFunctions'))
+import geopandas as gpd
+import depthmapXcli as dx
+from instrumentation import Instrumentation
+
+dataDir = os.path.join(sys.path[0], "..")
+barnsburyAxial = os.path.join(dataDir, "workshop/data/barnsbury/barnsbury_axial.mif")
+barnsburyExtended = os.path.join(dataDir, "data/barnsbury_extended1_segment.mif")
+galleryLines = os.path.join(dataDir, "workshop/data/gallery/gallery_lines.mif")
+
+gridSizes = [0.5, 0.25, 0.1, 0.08, 0.06, 0.04]
+segmentRadii = [["n"], ["n", "400"], ["n", "400", "800", "1200"], ["n", "400", "800", "1200", "2000", "3000"]]
+
+
+def axialToSegmentPipeline(workDir, lines, radii):
+    graphFile = os.path.join(workDir, "axial.graph")
+    segmentFile = os.path.join(workDir, "segment.graph")
+    dx.importLines(lines, graphFile)
+    dx.convertMap(graphFile, newMapName = "Axial Map", newMapType = "axial")
+    dx.convertMap(graphFile, segmentFile, newMapName = "Segment map", newMapType = "segment",
+                  stubLengthToRemove = 40, copyAttributes = True)
+    dx.segmentAnalysis(segmentFile, analysisType = "tulip", radii = radii, radiusType = "metric",
+                       tulipBins = 1024, includeChoice = True)
+    return segmentFile
+
+
+def segmentPipeline(workDir, lines, radii):
+    graphFile = os.path.join(workDir, "segment.graph")
+    dx.importLines(lines, graphFile)
+    dx.convertMap(graphFile, newMapName = "Segment map", newMapType = "segment")
+    dx.segmentAnalysis(graphFile, analysisType = "tulip", radii = radii, radiusType = "metric",
+                       tulipBins = 1024, includeChoice = True)
+    return graphFile
+
+
+def vgaPipeline(workDir, lines, gridSize):
+    graphFile = os.path.join(workDir, "gallery.graph")
+    dx.importLines(lines, graphFile)
+    dx.convertMap(graphFile, newMapName = "Plan", newMapType = "drawing")
+    dx.createGrid(graphFile, gridSize = gridSize)
+    dx.fillGrid(graphFile, fillX = 2.86, fillY = 6.68)
+    dx.makeVGAGraph(graphFile)
+    dx.VGA(graphFile, vgaMode = "visibility-global", radii = ["n"])
+    return graphFile
+
+
+def benchmarkCases():
+    # (series, x value, pipeline, loader of the results)
+    cases = []
+    axial = gpd.read_file(barnsburyAxial)
+    extended = gpd.read_file(barnsburyExtended)
+    gallery = gpd.read_file(galleryLines)
+    for radii in segmentRadii:
+        cases.append(("barnsbury_axial segment radii", len(radii),
+                      lambda workDir, radii = radii: axialToSegmentPipeline(workDir, axial, radii),
+                      dx.getShapeGraph))
+        cases.append(("barnsbury_extended1 segment radii", len(radii),
+                      lambda workDir, radii = radii: segmentPipeline(workDir, extended, radii),
+                      dx.getShapeGraph))
+    for gridSize in gridSizes:
+        cases.append(("gallery VGA grid size", gridSize,
+                      lambda workDir, gridSize = gridSize: vgaPipeline(workDir, gallery, gridSize),
+                      dx.getPointmapData))
+    return cases
+
+
+def runCase(pipeline, loader, repeats):
+    runs = []
+    for _ in range(repeats):
+        events = []
+        dx.setInstrumentation(Instrumentation(hooks = [events.append]))
+        try:
+            with tempfile.TemporaryDirectory() as workDir:
+                start = time.perf_counter()
+                graphFile = pipeline(workDir)
+                pipelineSeconds = time.perf_counter() - start
+                # the loader's own export counts as loading, not as pipeline time
+                loaded = len(events)
+                start = time.perf_counter()
+                result = loader(graphFile)
+                loaderSeconds = time.perf_counter() - start
+        finally:
+            dx.setInstrumentation(None)
+        cliEvents = [event for event in events[:loaded] if event["kind"] == "cli"]
+        runs.append({"wallSeconds": pipelineSeconds,
+                     "cliSeconds": sum(event["wallSeconds"] for event in cliEvents),
+                     "maxRSSBytes": max((event["maxRSSBytes"] or 0) for event in cliEvents),
+                     "loaderSeconds": loaderSeconds,
+                     "elements": len(result)})
+    # medians of the timings, the largest peak memory
+    return {"wallSeconds": statistics.median(run["wallSeconds"] for run in runs),
+            "cliSeconds": statistics.median(run["cliSeconds"] for run in runs),
+            "maxRSSBytes": max(run["maxRSSBytes"] for run in runs),
+            "loaderSeconds": statistics.median(run["loaderSeconds"] for run in runs),
+            "elements": runs[0]["elements"],
+            "repeats": repeats}
+
+
+# changes smaller than these are noise: short runs finish between two
+# readings of the peak memory, and timer jitter dominates sub 0.1s pipelines
+# and loads
+noiseFloor = {"wallSeconds": 0.1, "maxRSSBytes": 16 * 2 ** 20, "loaderSeconds": 0.05}
+
+
+def compareToBaseline(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for measure, floor in noiseFloor.items():
+            before, after = baseline[name][measure], result[measure]
+            if after > before * (1 + tolerance) and after - before > floor:
+                regressions.append((name, measure, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the depthmapXcli pipelines")
+    parser.add_argument("--baseline", default = os.path.join(sys.path[0], "baseline.json"))
+    parser.add_argument("--save-baseline", action = "store_true",
+                        help = "store the results as the new baseline")
+    parser.add_argument("--output", help = "write the results to this json file")
+    parser.add_argument("--repeats", type = int, default = 3)
+    parser.add_argument("--tolerance", type = float, default = 0.2,
+                        help = "allowed relative growth of wall time, peak memory and loading time")
+    parser.add_argument("--series", help = "only run the series whose name contains this")
+    args = parser.parse_args()
+
+    results = {}
+    for series, x, pipeline, loader in benchmarkCases():
+        if args.series is not None and args.series not in series:
+            continue
+        name = series + " " + str(x)
+        results[name] = dict(runCase(pipeline, loader, args.repeats), series = series, x = x)
+        result = results[name]
+        print("%-45s %9.3fs  cli %9.3fs  load %7.3fs  %8.1f MB  %7d elements" %
+              (name, result["wallSeconds"], result["cliSeconds"], result["loaderSeconds"],
+               result["maxRSSBytes"] / 2 ** 20, result["elements"]), flush = True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent = 2)
+        print("Baseline saved to " + args.baseline)
+        return 0
+    if not os.path.isfile(args.baseline):
+        print("No baseline at " + args.baseline + ", run with --save-baseline first")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compareToBaseline(results, baseline, args.tolerance)
+    for name, measure, before, after in regressions:
+        print("REGRESSION %s %s: %.4g -> %.4g (%+.0f%%)" %
+              (name, measure, before, after, 100 * (after / before - 1)))
+    if len(regressions) == 0:
+        print("No regressions against " + args.baseline)
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
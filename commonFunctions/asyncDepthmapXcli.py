@@ -0,0 +1,175 @@
+import os
+import time
+import asyncio
+import subprocess
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from . import depthmapXcli as dx
+    from .instrumentation import fileSize, paramValue
+except ImportError:
+    import depthmapXcli as dx
+    from instrumentation import fileSize, paramValue
+
+# Async versions of the depthmapXcli wrappers, for running many analyses
+# from one event loop. Each wrapper runs as is in a worker thread, but every
+# cli command line it issues is handed back to the event loop and run there
+# as an asyncio subprocess, so that:
+#  - at most concurrencyLimit cli processes run at any time
+#  - a cli run that goes over the timeout is killed (TimeoutExpired)
+#  - cancelling the awaiting task kills the running cli process
+#  - stdout and stderr lines are passed to onLine(streamName, line) as they
+#    are printed, with progress = True the cli prints its progress too
+# Instrumented async runs record wall time and file sizes, but no cpu times
+# or peak RSS (the event loop reaps the child and keeps its rusage).
+#
+#   await asyncDepthmapXcli.VGA("in.graph", "out.graph", timeout = 600)
+
+concurrencyLimit = os.cpu_count() or 1
+semaphores = {}
+
+# the wrapper threads only wait on the event loop, so there can be many
+wrapperThreads = ThreadPoolExecutor(max_workers = 64, thread_name_prefix = "depthmapXcli")
+
+
+def defaultConcurrency(memoryPerRun = None):
+    # one cli run per core, and if memoryPerRun (bytes) is given no more than
+    # fit in the physical memory
+    limit = os.cpu_count() or 1
+    if memoryPerRun is not None:
+        memory = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        limit = max(1, min(limit, memory // memoryPerRun))
+    return limit
+
+
+def setConcurrencyLimit(limit):
+    global concurrencyLimit
+    if limit < 1:
+        raise ValueError("The concurrency limit must be at least 1")
+    concurrencyLimit = limit
+    semaphores.clear()
+
+
+def getSemaphore():
+    # semaphores belong to an event loop, keep one per loop
+    loop = asyncio.get_running_loop()
+    if loop not in semaphores:
+        semaphores[loop] = asyncio.Semaphore(concurrencyLimit)
+    return semaphores[loop]
+
+
+async def readLines(stream, streamName, onLine, lines):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        lines.append(line)
+        if onLine is not None:
+            onLine(streamName, line.decode(errors = "replace").rstrip("\r\n"))
+
+
+async def runDepthmapXcliAsync(params, timeout = None, onLine = None, progress = False):
+    # the async counterpart of subprocess.check_output(params), raising
+    # CalledProcessError on failure and TimeoutExpired after killing the cli
+    if progress:
+        params = params[:1] + ["-p"] + params[1:]
+    async with getSemaphore():
+        # the event loop reaps the child, so there is no rusage to record and
+        # the cpu times and peak RSS of async runs are None
+        inputBytes = fileSize(paramValue(params, "-f"))
+        start = time.time()
+        startClock = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(*params, stdout = asyncio.subprocess.PIPE,
+                                                       stderr = asyncio.subprocess.PIPE)
+        stdout, stderr = [], []
+
+        def record():
+            if dx.instrumentation is not None:
+                dx.instrumentation.recordCli(params, start, time.perf_counter() - startClock,
+                                             process.returncode, pid = process.pid,
+                                             inputBytes = inputBytes)
+        try:
+            await asyncio.wait_for(asyncio.gather(readLines(process.stdout, "stdout", onLine, stdout),
+                                                  readLines(process.stderr, "stderr", onLine, stderr),
+                                                  process.wait()),
+                                   timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            record()
+            raise subprocess.TimeoutExpired(params, timeout, b"".join(stdout), b"".join(stderr))
+        except asyncio.CancelledError:
+            # runs that are killed are recorded too, with the signal as return code
+            process.kill()
+            await process.wait()
+            record()
+            raise
+    record()
+    output = b"".join(stdout)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, params, output, b"".join(stderr))
+    return output
+
+
+async def callAsync(function, *args, timeout = None, onLine = None, progress = False, **kwargs):
+    # runs a depthmapXcli wrapper in a worker thread, with its cli runs done
+    # by runDepthmapXcliAsync on this event loop. timeout applies to each cli run
+    loop = asyncio.get_running_loop()
+    running = set()
+
+    def runner(params):
+        future = asyncio.run_coroutine_threadsafe(
+            runDepthmapXcliAsync(params, timeout, onLine, progress), loop)
+        running.add(future)
+        try:
+            return future.result()
+        finally:
+            running.discard(future)
+
+    def call():
+        dx.cliRunner.set(runner)
+        return function(*args, **kwargs)
+
+    context = contextvars.copy_context()
+    try:
+        return await loop.run_in_executor(wrapperThreads, context.run, call)
+    except asyncio.CancelledError:
+        # cancelling the cli run kills it, the wrapper then fails in its thread
+        for future in list(running):
+            future.cancel()
+        raise
+
+
+def asyncVersion(function):
+    async def wrapper(*args, timeout = None, onLine = None, progress = False, **kwargs):
+        return await callAsync(function, *args, timeout = timeout, onLine = onLine,
+                               progress = progress, **kwargs)
+    wrapper.__name__ = function.__name__
+    wrapper.__qualname__ = function.__qualname__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+importLines = asyncVersion(dx.importLines)
+convertMap = asyncVersion(dx.convertMap)
+export = asyncVersion(dx.export)
+getPointmapData = asyncVersion(dx.getPointmapData)
+getPointmapLinks = asyncVersion(dx.getPointmapLinks)
+getPointmapConnections = asyncVersion(dx.getPointmapConnections)
+getPointmapDataAndLinks = asyncVersion(dx.getPointmapDataAndLinks)
+getShapeGraph = asyncVersion(dx.getShapeGraph)
+getShapeGraphConnections = asyncVersion(dx.getShapeGraphConnections)
+getShapeGraphLinksUnlinks = asyncVersion(dx.getShapeGraphLinksUnlinks)
+axialAnalysis = asyncVersion(dx.axialAnalysis)
+segmentAnalysis = asyncVersion(dx.segmentAnalysis)
+createGrid = asyncVersion(dx.createGrid)
+fillGrid = asyncVersion(dx.fillGrid)
+makeVGAGraph = asyncVersion(dx.makeVGAGraph)
+unmakeVGAGraph = asyncVersion(dx.unmakeVGAGraph)
+VGA = asyncVersion(dx.VGA)
+linkMapCoords = asyncVersion(dx.linkMapCoords)
+linkMapRefs = asyncVersion(dx.linkMapRefs)
+makeIsovists = asyncVersion(dx.makeIsovists)
+getIsovists = asyncVersion(dx.getIsovists)
+agentAnalysis = asyncVersion(dx.agentAnalysis)
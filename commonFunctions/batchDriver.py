@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from . import depthmapXcli as dx
+except ImportError:
+    import depthmapXcli as dx
+
+# Batch runs of many maps from the command line:
+#
+#   python batchDriver.py jobs.jsonl --db batch.sqlite --output results/
+#
+# The manifest has one json job per line, with an id, an input (anything
+# geopandas reads: shapefile, MIF, DXF, ... or a ready .graph) and the
+# analysis to run, one of:
+#
+#   {"id": "n1", "input": "n1.mif", "analysis": "axial", "radii": ["n", "3"]}
+#   {"id": "n1-seg", "input": "n1.mif", "analysis": "segment", "radii": ["n", "400"],
+#    "stubLengthToRemove": 40, "includeChoice": true}
+#   {"id": "floor3", "input": "floor3.dxf", "analysis": "vga", "gridSize": 0.5,
+#    "fillX": 12.1, "fillY": 30.5, "vgaMode": "visibility-global"}
+#
+# Other keys are passed on to axialAnalysis/segmentAnalysis/VGA, and
+# "memoryMB" overrides the memory estimate of a job. Jobs run in a process
+# pool and are only admitted while the estimated memory of the running jobs
+# fits in the budget, so that big VGA jobs don't all run at once. The status
+# of every job is kept in a sqlite database, results are written as one
+# parquet file per job, and a job only counts as done once its file is in
+# place, so a rerun skips finished jobs and a crash loses only running ones.
+
+analysisOptions = {"axial": ["radii", "includeChoice", "includeLocal", "includeIntermediateMetrics"],
+                   "segment": ["analysisType", "radii", "radiusType", "tulipBins",
+                               "weightWithColumn", "includeChoice"],
+                   "vga": ["vgaMode", "radii"]}
+
+
+def readManifest(manifestPath):
+    jobs = []
+    with open(manifestPath) as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            job = json.loads(line)
+            if "id" not in job or "input" not in job:
+                raise ValueError("Jobs need an id and an input: " + line.strip())
+            if job.get("analysis") not in analysisOptions:
+                raise ValueError("Unknown analysis for job " + str(job["id"]) + ": " +
+                                 str(job.get("analysis")))
+            if job["analysis"] == "vga" and not all(key in job for key in ["gridSize", "fillX", "fillY"]):
+                raise ValueError("VGA job " + str(job["id"]) + " needs gridSize, fillX and fillY")
+            jobs.append(job)
+    ids = [job["id"] for job in jobs]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Job ids must be unique")
+    return jobs
+
+
+def jobSignature(job):
+    # the job spec and the state of its input, a rerun redoes jobs whose signature changed
+    st = os.stat(job["input"])
+    digest = hashlib.sha256(json.dumps(job, sort_keys = True).encode())
+    digest.update(("%d %d" % (st.st_size, st.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+def estimateMemoryMB(job):
+    # rough peak memory of the cli: the visibility graph of a VGA grows with
+    # the square of the number of cells, line analyses with the number of
+    # lines. Only the metadata of the input is read, not its features
+    if "memoryMB" in job:
+        return job["memoryMB"]
+    if job["input"].endswith(".graph"):
+        return 8 + 4 * os.path.getsize(job["input"]) / 2 ** 20
+    import pyogrio
+    info = pyogrio.read_info(job["input"], force_total_bounds = job["analysis"] == "vga")
+    if job["analysis"] == "vga":
+        bounds = info["total_bounds"]
+        cells = (bounds[2] - bounds[0]) * (bounds[3] - bounds[1]) / job["gridSize"] ** 2
+        return 8 + cells * cells / 2 ** 20
+    # formats that don't know their feature count: about 100 bytes a line
+    lines = info["features"] if info["features"] >= 0 else os.path.getsize(job["input"]) / 100
+    return 8 + 2 * lines / 2 ** 10
+
+
+def buildGraph(job, graphFile, cliPath):
+    if job["input"].endswith(".graph"):
+        shutil.copyfile(job["input"], graphFile)
+        return
+    import geopandas
+    lines = geopandas.read_file(job["input"])
+    # only numeric attributes can be imported with the lines
+    lines = lines[[col for col in lines.columns
+                   if col == lines.geometry.name or lines[col].dtype.kind in "biuf"]]
+    dx.importLines(lines, graphFile, cliPath)
+    if job["analysis"] == "vga":
+        dx.convertMap(graphFile, newMapType = "drawing", newMapName = "Plan", cliPath = cliPath)
+        dx.createGrid(graphFile, gridSize = job["gridSize"], cliPath = cliPath)
+        dx.fillGrid(graphFile, fillX = job["fillX"], fillY = job["fillY"], cliPath = cliPath)
+        dx.makeVGAGraph(graphFile, cliPath = cliPath)
+        return
+    dx.convertMap(graphFile, newMapType = "axial", newMapName = "Axial Map", cliPath = cliPath)
+    if job["analysis"] == "segment":
+        dx.convertMap(graphFile, newMapType = "segment", newMapName = "Segment Map",
+                      stubLengthToRemove = job.get("stubLengthToRemove"), copyAttributes = True,
+                      cliPath = cliPath)
+
+
+def runJob(task):
+    job, outputPath, cliPath = task
+    start = time.time()
+    options = {key: job[key] for key in analysisOptions[job["analysis"]] if key in job}
+    with dx.workspace() as tmpDir:
+        graphFile = os.path.join(tmpDir, "job.graph")
+        buildGraph(job, graphFile, cliPath)
+        if job["analysis"] == "axial":
+            dx.axialAnalysis(graphFile, cliPath = cliPath, **options)
+            result = dx.getShapeGraph(graphFile, cliPath)
+        elif job["analysis"] == "segment":
+            options.setdefault("tulipBins", 1024)
+            dx.segmentAnalysis(graphFile, cliPath = cliPath, **options)
+            result = dx.getShapeGraph(graphFile, cliPath)
+        else:
+            dx.VGA(graphFile, cliPath = cliPath, **options)
+            result = dx.getPointmapData(graphFile, cliPath = cliPath)
+    result.to_parquet(outputPath + ".tmp")
+    os.replace(outputPath + ".tmp", outputPath)
+    return len(result), time.time() - start
+
+
+def openManifestDB(dbPath):
+    db = sqlite3.connect(dbPath)
+    db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                      id TEXT PRIMARY KEY,
+                      signature TEXT,
+                      status TEXT,
+                      spec TEXT,
+                      output TEXT,
+                      rows INTEGER,
+                      seconds REAL,
+                      started REAL,
+                      finished REAL,
+                      error TEXT)""")
+    db.commit()
+    return db
+
+
+def setStatus(db, jobId, **values):
+    columns = ", ".join(key + " = ?" for key in values)
+    db.execute("UPDATE jobs SET " + columns + " WHERE id = ?", list(values.values()) + [jobId])
+    db.commit()
+
+
+def failJob(db, job, signature, error):
+    db.execute("INSERT OR REPLACE INTO jobs (id, signature, status, spec, finished, error) "
+               "VALUES (?, ?, ?, ?, ?, ?)",
+               (str(job["id"]), signature, "failed", json.dumps(job), time.time(), error))
+    db.commit()
+    print("failed %s" % job["id"], flush = True)
+
+
+def jobsToRun(db, jobs, outputDir, retryFailed):
+    # returns the jobs to run and the number of jobs that failed already,
+    # such as those with a missing input
+    toRun = []
+    failed = 0
+    for job in jobs:
+        try:
+            signature = jobSignature(job)
+        except OSError:
+            failJob(db, job, None, traceback.format_exc())
+            failed += 1
+            continue
+        outputPath = os.path.join(outputDir, str(job["id"]) + ".parquet")
+        row = db.execute("SELECT signature, status FROM jobs WHERE id = ?", (str(job["id"]),)).fetchone()
+        if row is not None and row[0] == signature:
+            if row[1] == "done" and os.path.isfile(outputPath):
+                continue
+            if row[1] == "failed" and not retryFailed:
+                continue
+        db.execute("INSERT OR REPLACE INTO jobs (id, signature, status, spec, output) VALUES (?, ?, ?, ?, ?)",
+                   (str(job["id"]), signature, "pending", json.dumps(job), outputPath))
+        toRun.append((job, outputPath))
+    db.commit()
+    return toRun, failed
+
+
+def runBatch(manifestPath, dbPath, outputDir, processes = None, memoryBudgetMB = None,
+             retryFailed = False, cliPath = None):
+    jobs = readManifest(manifestPath)
+    os.makedirs(outputDir, exist_ok = True)
+    db = openManifestDB(dbPath)
+    pending, failed = jobsToRun(db, jobs, outputDir, retryFailed)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if memoryBudgetMB is None:
+        memoryBudgetMB = 0.8 * os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    print("%d of %d jobs to run" % (len(pending), len(jobs)), flush = True)
+
+    counts = {"done": 0, "failed": failed}
+    # memory estimates are made as jobs come up for admission
+    estimates = {}
+    running = {}
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            # admit jobs in manifest order while they fit, a job bigger than
+            # the whole budget runs on its own
+            for job, outputPath in list(pending):
+                if len(running) >= processes:
+                    break
+                if job["id"] not in estimates:
+                    try:
+                        estimates[job["id"]] = estimateMemoryMB(job)
+                    except Exception:
+                        pending.remove((job, outputPath))
+                        failJob(db, job, jobSignature(job), traceback.format_exc())
+                        counts["failed"] += 1
+                        continue
+                inUse = sum(estimates[running[future]["id"]] for future in running)
+                if len(running) > 0 and inUse + estimates[job["id"]] > memoryBudgetMB:
+                    break
+                pending.remove((job, outputPath))
+                setStatus(db, str(job["id"]), status = "running", started = time.time())
+                running[executor.submit(runJob, (job, outputPath, cliPath))] = job
+            if len(running) == 0:
+                continue
+            completed, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in completed:
+                job = running.pop(future)
+                try:
+                    rows, seconds = future.result()
+                    setStatus(db, str(job["id"]), status = "done", rows = rows, seconds = seconds,
+                              finished = time.time(), error = None)
+                    counts["done"] += 1
+                    print("done   %s (%d rows, %.1fs)" % (job["id"], rows, seconds), flush = True)
+                except Exception:
+                    setStatus(db, str(job["id"]), status = "failed", finished = time.time(),
+                              error = traceback.format_exc())
+                    counts["failed"] += 1
+                    print("failed %s" % job["id"], flush = True)
+    db.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run depthmapX analyses for a manifest of maps")
+    parser.add_argument("manifest", help = "json-lines file with one job per line")
+    parser.add_argument("--db", default = "batch.sqlite", help = "job status database")
+    parser.add_argument("--output", default = "results", help = "directory for the parquet results")
+    parser.add_argument("--processes", type = int, default = None)
+    parser.add_argument("--memory-budget-mb", type = float, default = None,
+                        help = "estimated memory the running jobs may use (default 80%% of RAM)")
+    parser.add_argument("--retry-failed", action = "store_true")
+    parser.add_argument("--cli", default = None, help = "path to depthmapXcli")
+    args = parser.parse_args()
+    counts = runBatch(args.manifest, args.db, args.output, args.processes, args.memory_budget_mb,
+                      args.retry_failed, args.cli)
+    print("%d done, %d failed" % (counts["done"], counts["failed"]))
+    return 1 if counts["failed"] > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
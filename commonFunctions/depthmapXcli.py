@@ -1,52 +1,193 @@
 import os
 import platform
+import signal
 import subprocess
-import geopandas
-import pandas as pd
-import numpy as np
 import tempfile
 import string
 import random
-from shapely.geometry import Point
-
-def getDepthmapXcli():
+import contextvars
+import contextlib
+import threading
+import io
+
+# the depthmapXcli binary run when a wrapper is given no cliPath: the one set
+# with setDepthmapXcli, else the DEPTHMAPXCLI environment variable, else the
+# one for this platform in the lib folder next to commonFunctions. It is
+# resolved and checked once, on the first cli run. geopandas, pandas, numpy
+# and shapely are likewise only imported by the functions that need them
+cliPathOverride = None
+resolvedCliPath = None
+environBeforeOverride = None
+
+
+def setDepthmapXcli(path = None):
+    # None goes back to DEPTHMAPXCLI or the bundled binary. The path is also
+    # exported as DEPTHMAPXCLI, so that worker processes started with spawn
+    # (which don't inherit module globals) run the same binary
+    global cliPathOverride, resolvedCliPath, environBeforeOverride
+    if path is not None:
+        if cliPathOverride is None:
+            environBeforeOverride = os.environ.get("DEPTHMAPXCLI")
+        os.environ["DEPTHMAPXCLI"] = os.path.abspath(path)
+    elif cliPathOverride is not None:
+        if environBeforeOverride is None:
+            os.environ.pop("DEPTHMAPXCLI", None)
+        else:
+            os.environ["DEPTHMAPXCLI"] = environBeforeOverride
+    cliPathOverride = path
+    resolvedCliPath = None
+
+
+def bundledDepthmapXcli():
     # this just selects the correct depthmapXcli from the lib folder, depending on the
-    # depending on the operating system jupyter python is running on (darwin is macOS)
-    
+    # operating system python is running on (darwin is macOS)
+    libDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib")
     if platform.system() == "Windows":
-        depthmapXcli = "../lib/depthmapXcli.exe"
+        return os.path.join(libDir, "depthmapXcli.exe")
     elif platform.system() == "Darwin":
-        depthmapXcli = "../lib/depthmapXcli.darwin"
+        return os.path.join(libDir, "depthmapXcli.darwin")
     elif platform.system() == "Linux":
-        depthmapXcli = "../lib/depthmapXcli.linux"
-        # in linux it's necessary to make the cli executable
-        new_mode = os.stat(depthmapXcli).st_mode | 0o100
-        os.chmod(depthmapXcli,new_mode)
-    else:
-        raise ValueError('Unknown platform: ' + platform.system())
+        return os.path.join(libDir, "depthmapXcli.linux")
+    raise ValueError('Unknown platform: ' + platform.system())
+
+
+def getDepthmapXcli():
+    global resolvedCliPath
+    if resolvedCliPath is not None:
+        return resolvedCliPath
+    depthmapXcli = cliPathOverride or os.environ.get("DEPTHMAPXCLI") or bundledDepthmapXcli()
+    depthmapXcli = os.path.abspath(depthmapXcli)
+    if not os.path.isfile(depthmapXcli):
+        raise ValueError("depthmapXcli not found at " + depthmapXcli)
+    if platform.system() != "Windows" and not os.access(depthmapXcli, os.X_OK):
+        # the binaries may be checked out without the executable bit
+        os.chmod(depthmapXcli, os.stat(depthmapXcli).st_mode | 0o100)
+    resolvedCliPath = depthmapXcli
     return depthmapXcli
 
 
-def importLines(lineMap, graphFileOut, cliPath = getDepthmapXcli()):
+def withCli(params):
+    # wrappers given no cliPath leave it as None at the start of the command line
+    if params[0] is None:
+        return [getDepthmapXcli()] + list(params[1:])
+    return params
+
+
+# optional ResultCache (see resultCache.py) consulted by the analysis wrappers,
+# set with setResultCache(ResultCache("path/to/cache"))
+resultCache = None
+
+
+def setResultCache(cache):
+    global resultCache
+    resultCache = cache
+
+
+# optional ResultStore (see resultStore.py) keeping GeoParquet copies of the
+# tables read by getShapeGraph and getPointmapData, set with
+# setResultStore(ResultStore())
+resultStore = None
+
+
+def setResultStore(store):
+    global resultStore
+    resultStore = store
+
+
+# function that runs a cli command line in place of subprocess.check_output,
+# set per context by the async wrappers in asyncDepthmapXcli.py
+cliRunner = contextvars.ContextVar("cliRunner", default = None)
+
+
+# optional Instrumentation (see instrumentation.py) recording every cli run
+# and export parse, set with setInstrumentation(Instrumentation("runs.jsonl"))
+instrumentation = None
+
+
+def setInstrumentation(recorder):
+    global instrumentation
+    instrumentation = recorder
+
+
+def parsing(name, path):
+    # times the parsing of an exported file when instrumentation is set
+    if instrumentation is None:
+        return contextlib.nullcontext()
+    return instrumentation.span(name, path = path, bytes = os.path.getsize(path))
+
+
+def executeCli(params):
+    params = withCli(params)
+    runner = cliRunner.get()
+    if runner is not None:
+        return runner(params)
+    if instrumentation is not None:
+        return instrumentation.runCli(params)
+    return subprocess.check_output(params)
+
+
+# LinkSessions (see linkSession.py) with link edits queued, by the absolute
+# path of the graph they edit. A cli run on that graph applies them first
+pendingEdits = {}
+
+
+def flushPendingEdits(params):
+    if len(pendingEdits) > 0 and "-f" in params:
+        session = pendingEdits.get(os.path.abspath(params[params.index("-f") + 1]))
+        if session is not None:
+            session.flush()
+
+
+def runDepthmapXcli(params, cacheAs = None):
+    # runs the cli with the given parameters. If a result cache is set and the
+    # wrapper asks for caching (cacheAs is the wrapper name) the output file is
+    # restored from the cache when the same input ran with the same parameters
+    params = withCli(params)
+    flushPendingEdits(params)
+    if resultCache is None or cacheAs is None:
+        return executeCli(params)
+    fileOut = params[params.index("-o") + 1]
+    key = resultCache.makeKey(cacheAs, params)
+    if resultCache.restore(key, fileOut):
+        return
+    output = executeCli(params)
+    resultCache.store(key, fileOut)
+    return output
+
+
+def lineSegments(lineMap):
+    import numpy as np
+    import pandas as pd
+    import shapely
+    # breaks all lines of the map down to 2-point segments in one vectorised
+    # pass, repeating the attributes of each polyline for all of its segments
     gdf = lineMap.explode(index_parts=False)
-    allCoordSizes = gdf.geometry.apply( lambda line: len(line.coords) != 2)
-    if allCoordSizes.any():
-        raise ValueError('The included map contains polylines, please break down to 2-point segments')
-    lineCoords = gdf.geometry.apply( lambda line: line.coords).apply(np.ravel)
-    df = pd.DataFrame(gdf[[col for col in gdf.columns if col != gdf._geometry_column_name]])
-    df['x1'] = lineCoords.apply( lambda line: line[0])
-    df['y1'] = lineCoords.apply( lambda line: line[1])
-    df['x2'] = lineCoords.apply( lambda line: line[2])
-    df['y2'] = lineCoords.apply( lambda line: line[3])
-    with tempfile.NamedTemporaryFile(suffix='.tsv', delete=False) as tmp:
-        df.to_csv(tmp, sep='\t', index=False)
-        subprocess.check_output([cliPath,
-                             "-f",  tmp.name,
-                             "-o",  graphFileOut,
-                             "-m",  "IMPORT",
-                             "-it", "data"])
-        tmp.close()
-        
+    if not (gdf.geom_type == "LineString").all():
+        raise ValueError('The included map contains geometries that are not lines')
+    coords, owners = shapely.get_coordinates(gdf.geometry.values, return_index=True)
+    # a segment starts at every vertex followed by another vertex of the same line
+    starts = np.flatnonzero(owners[:-1] == owners[1:])
+    df = pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).iloc[owners[starts]]
+    df = df.reset_index(drop=True)
+    df['x1'] = coords[starts, 0]
+    df['y1'] = coords[starts, 1]
+    df['x2'] = coords[starts + 1, 0]
+    df['y2'] = coords[starts + 1, 1]
+    return df
+
+
+def importLines(lineMap, graphFileOut, cliPath = None):
+    df = lineSegments(lineMap)
+    with workspace() as tmpDir:
+        # the cli opens its input more than once, so it can't be given a pipe
+        tsvPath = os.path.join(tmpDir, "lines.tsv")
+        df.to_csv(tsvPath, sep='\t', index=False)
+        runDepthmapXcli([cliPath,
+                         "-f",  tsvPath,
+                         "-o",  graphFileOut,
+                         "-m",  "IMPORT",
+                         "-it", "data"])
+
 
 def generateRandomCapString(n = 10):
     return ''.join(random.choice(string.ascii_lowercase) for _ in range(n))
@@ -54,7 +195,7 @@ def generateRandomCapString(n = 10):
 
 def convertMap(graphFileIn, graphFileOut = None, newMapType = "axial", newMapName = generateRandomCapString(10),
                removeInputMap = False, copyAttributes = False, stubLengthToRemove = None,
-               cliPath = getDepthmapXcli()):
+               cliPath = None):
     if graphFileOut is None:
         graphFileOut = graphFileIn;
     if newMapType not in ["drawing", "axial", "segment", "data", "convex"]:
@@ -73,96 +214,287 @@ def convertMap(graphFileIn, graphFileOut = None, newMapType = "axial", newMapNam
     if stubLengthToRemove is not None:
         params.extend(["-crsl", str(stubLengthToRemove)])
 
-    subprocess.check_output(params)
+    runDepthmapXcli(params, "convertMap")
     
     
     
 def export(graphFileIn, fileOut, exportType,
-                  cliPath = getDepthmapXcli()):
-    subprocess.check_output([cliPath,
-                             "-f", graphFileIn,
-                             "-o", fileOut,
-                             "-m", "EXPORT",
-                             "-em", exportType])
-
-
-def getPointmapData(graphFileIn, scale = 1, cliPath = getDepthmapXcli()):
-    
-    with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as mapFile:
-        export(graphFileIn, mapFile.name, "pointmap-data-csv", cliPath)
-        dpm = processPointMap(mapFile, scale, ",")
-        mapFile.close()
-        return(dpm);
-
-
-def getPointmapLinks(graphFileIn, cliPath = getDepthmapXcli()):
-    with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as csvFile:
-        export(graphFileIn, csvFile.name, "pointmap-links-csv", cliPath)
-        links = read.csv(csvFile)
-        csvFile.close()
-        return(links);
-
-
-def getPointmapDataAndLinks(graphFileIn, scale = 1, cliPath = getDepthmapXcli()):
-    with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as mapFile, tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as linkFile:
-        export(graphFileIn, mapFile.name, "pointmap-data-csv")
-        export(graphFileIn, linkFile.name, "pointmap-links-csv")
-        dpm = processPointMapAndLinks(mapFile, linkFile, scale, ",")
-        mapFile.close()
-        linkFile.close()
-        return(dpm);
+                  cliPath = None):
+    runDepthmapXcli([cliPath,
+                     "-f", graphFileIn,
+                     "-o", fileOut,
+                     "-m", "EXPORT",
+                     "-em", exportType], "export")
+
+
+# directory in which the getters write their exports and the wrappers their
+# temporary files, e.g. ramWorkspaceRoot() to keep them off the disk. None
+# is the system temporary directory. With streamExports the csv exports are
+# written to a named pipe and parsed while the cli writes them
+workspaceRoot = None
+streamExports = False
+
+
+def setWorkspace(root = None, streamCsvExports = False):
+    global workspaceRoot, streamExports
+    if streamCsvExports and not hasattr(os, "mkfifo"):
+        raise ValueError("Named pipes are not available on this platform")
+    workspaceRoot = root
+    streamExports = streamCsvExports
+
+
+def ramWorkspaceRoot():
+    # /dev/shm where it exists (linux), otherwise the system temporary directory
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return None
+
+
+def workspace():
+    # a temporary directory that is removed with everything in it on exit,
+    # also usable for intermediate .graph files:
+    #   with workspace() as tmpDir: ...
+    return tempfile.TemporaryDirectory(prefix = "depthmapX", dir = workspaceRoot)
+
+
+def streamExport(graphFileIn, fifoPath, exportType, reader, cliPath):
+    # the cli writes to the pipe from a thread while reader consumes it. The
+    # export is not cached, there is no file to keep
+    flushPendingEdits(["-f", graphFileIn])
+    os.mkfifo(fifoPath)
+    failure = []
+    readerDone = threading.Event()
+
+    def runExport():
+        try:
+            executeCli([cliPath,
+                        "-f", graphFileIn,
+                        "-o", fifoPath,
+                        "-m", "EXPORT",
+                        "-em", exportType])
+        except BaseException as error:
+            failure.append(error)
+            # the cli may have failed before opening the pipe, end the reader's stream
+            while not readerDone.is_set():
+                try:
+                    os.close(os.open(fifoPath, os.O_WRONLY | os.O_NONBLOCK))
+                    break
+                except OSError:
+                    readerDone.wait(0.01)
+
+    # in the caller's context, so that the cli runs where the caller's would (see cliRunner)
+    thread = threading.Thread(target = contextvars.copy_context().run, args = (runExport,), daemon = True)
+    thread.start()
+    try:
+        result = reader(fifoPath)
+    except BaseException:
+        readerDone.set()
+        # a cli still waiting to open the pipe is let through, it then stops on a broken pipe
+        while thread.is_alive():
+            try:
+                os.close(os.open(fifoPath, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            thread.join(0.01)
+        # a failed cli explains an empty or cut short stream better than the
+        # reader, but a cli stopped by the broken pipe only failed because the
+        # reader gave up first
+        if len(failure) > 0 and getattr(failure[0], "returncode", None) != -signal.SIGPIPE:
+            raise failure[0]
+        raise
+    readerDone.set()
+    thread.join()
+    if len(failure) > 0:
+        raise failure[0]
+    return result
+
+
+def readExport(graphFileIn, exportType, reader, suffix = ".csv", cliPath = None):
+    # exports into the workspace and returns reader(path). The export is
+    # deleted afterwards (for .mif exports the .mid as well)
+    with workspace() as tmpDir:
+        path = os.path.join(tmpDir, "export" + suffix)
+        if streamExports and suffix == ".csv":
+            return streamExport(graphFileIn, path, exportType, reader, cliPath)
+        export(graphFileIn, path, exportType, cliPath)
+        return reader(path)
+
+
+def getPointmapData(graphFileIn, scale = 1, cliPath = None, columns = None, downcast = False,
+                    geometry = True, engine = None):
+    # the result store only keeps the point map as exported (scale 1, full
+    # precision, with geometry)
+    useStore = resultStore is not None and scale == 1 and not downcast and geometry
+    if useStore:
+        stored = loadStored(graphFileIn, "pointmap", columns)
+        if stored is not None:
+            return stored
+    def reader(path):
+        with parsing("processPointMap", path):
+            return processPointMap(path, scale, ",", None if useStore else columns,
+                                   downcast, geometry, engine)
+    pointMap = readExport(graphFileIn, "pointmap-data-csv", reader, cliPath = cliPath)
+    if useStore:
+        resultStore.save(graphFileIn, "pointmap", pointMap, ["Ref", "i", "j"])
+        if columns is not None:
+            missing = [col for col in columns if col not in pointMap.columns]
+            if len(missing) > 0:
+                raise ValueError("Columns not found in point map: " + ", ".join(missing))
+            pointMap = pointMap[[col for col in pointMap.columns
+                                 if col in columns or col in ["Ref", "i", "j", pointMap.geometry.name]]]
+    return pointMap
+
+
+def getPointmapLinks(graphFileIn, cliPath = None):
+    import pandas as pd
+    def reader(path):
+        with parsing("getPointmapLinks", path):
+            return pd.read_csv(path, sep = ",")
+    return readExport(graphFileIn, "pointmap-links-csv", reader, cliPath = cliPath)
+
+
+def getPointmapConnections(graphFileIn, cliPath = None):
+    import pandas as pd
+    def reader(path):
+        with parsing("getPointmapConnections", path):
+            return pd.read_csv(path, sep = ",")
+    return readExport(graphFileIn, "pointmap-connections-csv", reader, cliPath = cliPath)
+
+
+def getPointmapDataAndLinks(graphFileIn, scale = 1, cliPath = None):
+    links = getPointmapLinks(graphFileIn, cliPath)
+    def reader(path):
+        with parsing("processPointMap", path):
+            return processPointMap(path, scale, ",")
+    return (readExport(graphFileIn, "pointmap-data-csv", reader, cliPath = cliPath), links)
 
 def refIDtoIndex(refID):
     i = refID >> 16;
     j = refID & 0x0000FFFF;
     return [i,j];
 
-def processPointMap(filepath, scale = 1, sep = "\t"):
-    pointMapData = pd.read_csv(filepath, sep=sep);
-    pointMapData['x'] = pointMapData['x']*scale;
-    pointMapData['y'] = pointMapData['y']*scale;
-    ij = pd.DataFrame(np.transpose(refIDtoIndex(pointMapData['Ref'].values)), columns=['i', 'j'])
-    pointMapData = pd.concat([pointMapData, ij], axis=1, sort=False)
-    pointMapData['coords'] = list(zip(pointMapData.x, pointMapData.y))
-    pointMapData['coords'] = pointMapData['coords'].apply(Point)
-    dpm = geopandas.GeoDataFrame( pointMapData[list(set(list(pointMapData)) - set(["x","y"]))], geometry='coords')
-    return dpm;
+class ReplayedStream(io.RawIOBase):
+    # a stream that starts with bytes already read from it (the header line)
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if len(self.head) > 0:
+            n = min(len(buffer), len(self.head))
+            buffer[:n] = self.head[:n]
+            self.head = self.head[n:]
+            return n
+        return self.stream.readinto(buffer)
+
+
+def readPointMap(headerLine, f, sep, columns, downcast, engine):
+    import numpy as np
+    import pandas as pd
+    header = list(pd.read_csv(io.BytesIO(headerLine), sep=sep, nrows=0).columns)
+    if columns is None:
+        columns = [col for col in header if col not in ["Ref", "x", "y"]]
+    else:
+        missing = [col for col in columns if col not in header]
+        if len(missing) > 0:
+            raise ValueError("Columns not found in point map: " + ", ".join(missing))
+        columns = [col for col in header if col in columns and col not in ["Ref", "x", "y"]]
+    dtypes = {"Ref": np.int64, "x": np.float64, "y": np.float64}
+    if downcast:
+        dtypes.update({col: np.float32 for col in columns})
+    pointMapData = pd.read_csv(io.BufferedReader(ReplayedStream(headerLine, f)), sep=sep,
+                               usecols=["Ref", "x", "y"] + columns, dtype=dtypes, engine=engine)
+    return pointMapData[["Ref", "x", "y"] + columns]
+
+
+def processPointMap(filepath, scale = 1, sep = "\t", columns = None, downcast = False,
+                    geometry = True, engine = None):
+    import geopandas
+    import numpy as np
+    # columns: only load these measures (Ref, x and y are always loaded)
+    # downcast: load measures as float32 and grid indices as int32
+    # geometry: build point geometries, otherwise return a dict of numpy arrays
+    # engine: pandas csv engine, "pyarrow" is much faster on large exports
+    # the file is read in one pass so that it can also be a named pipe
+    with open(filepath, "rb") as f:
+        headerLine = f.readline()
+        pointMapData = readPointMap(headerLine, f, sep, columns, downcast, engine)
+    columns = [col for col in pointMapData.columns if col not in ["Ref", "x", "y"]]
+    x = pointMapData['x'].values*scale
+    y = pointMapData['y'].values*scale
+    i, j = refIDtoIndex(pointMapData['Ref'].values)
+    indexType = np.int32 if downcast else np.int64
+    if not geometry:
+        arrays = {col: pointMapData[col].values for col in ["Ref"] + columns}
+        arrays.update({'i': i.astype(indexType), 'j': j.astype(indexType), 'x': x, 'y': y})
+        return arrays
+    dpm = pointMapData[["Ref"] + columns]
+    dpm = dpm.assign(i=i.astype(indexType), j=j.astype(indexType))
+    dpm = geopandas.GeoDataFrame(dpm, geometry=geopandas.points_from_xy(x, y))
+    return dpm.rename_geometry('coords')
 
 def processPointMapAndLinks(mapPath, linkPath = None, scale = 1, sep = "\t"):
+    import pandas as pd
     pointMap = processPointMap(mapPath, scale, sep)
     links = None
     if linkPath is not None:
-        links = pd.read.csv(linkPath, sep = sep)
+        links = pd.read_csv(linkPath, sep = sep)
     return (pointMap, links)
 
 
-def getShapeGraph(graphFileIn, cliPath = getDepthmapXcli()):
-    with tempfile.NamedTemporaryFile(suffix='.mif', delete=False) as mapFile:
-        export(graphFileIn, mapFile.name, "shapegraph-map-mif", cliPath)
-        ogr = geopandas.read_file(mapFile.name)
-        mapFile.close()
-        return(ogr);
-
-
-def getShapeGraphConnections(graphFileIn, cliPath = getDepthmapXcli()):
-    with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as connectionsFile:
-        export(graphFileIn, connectionsFile.name, "shapegraph-connections-csv", cliPath)
-        csv = pd.read_csv(connectionsFile.name, header = True, sep = ",")
-        connectionsFile.close()
-        return(csv);
-
-
-def getShapeGraphLinksUnlinks(graphFileIn, cliPath = getDepthmapXcli()):
-    with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as linksunlinksFile:
-        export(graphFileIn, linksunlinksFile.name, "shapegraph-links-unlinks-csv", cliPath)
-        csv = pd.read_csv(linksunlinksFile.name, header = True, sep = ",")
-        linksunlinksFile.close()
-        return(csv);
+def loadStored(graphFileIn, table, columns):
+    # queued link edits change the graph, apply them before looking it up
+    flushPendingEdits(["-f", graphFileIn])
+    return resultStore.load(graphFileIn, table, columns)
+
+
+def getShapeGraph(graphFileIn, cliPath = None, columns = None):
+    import geopandas
+    # columns: only return these measures (Depthmap_Ref and the geometry are
+    # always returned)
+    if resultStore is not None:
+        stored = loadStored(graphFileIn, "shapegraph", columns)
+        if stored is not None:
+            return stored
+    # mif/mid pairs can't be streamed, they are read from the workspace
+    def reader(path):
+        with parsing("getShapeGraph", path):
+            return geopandas.read_file(path)
+    shapeGraph = readExport(graphFileIn, "shapegraph-map-mif", reader, ".mif", cliPath)
+    if resultStore is not None:
+        resultStore.save(graphFileIn, "shapegraph", shapeGraph, ["Depthmap_Ref"])
+    if columns is not None:
+        missing = [col for col in columns if col not in shapeGraph.columns]
+        if len(missing) > 0:
+            raise ValueError("Columns not found in shape graph: " + ", ".join(missing))
+        shapeGraph = shapeGraph[[col for col in shapeGraph.columns
+                                 if col in columns or col in ["Depthmap_Ref", shapeGraph.geometry.name]]]
+    return shapeGraph
+
+
+def getShapeGraphConnections(graphFileIn, cliPath = None):
+    import pandas as pd
+    def reader(path):
+        with parsing("getShapeGraphConnections", path):
+            return pd.read_csv(path, sep = ",")
+    return readExport(graphFileIn, "shapegraph-connections-csv", reader, cliPath = cliPath)
+
+
+def getShapeGraphLinksUnlinks(graphFileIn, cliPath = None):
+    import pandas as pd
+    def reader(path):
+        with parsing("getShapeGraphLinksUnlinks", path):
+            return pd.read_csv(path, sep = ",")
+    return readExport(graphFileIn, "shapegraph-links-unlinks-csv", reader, cliPath = cliPath)
     
     
 def axialAnalysis(graphFileIn, graphFileOut = None, radii = ["n"], includeChoice = False,
                          includeLocal = False, includeIntermediateMetrics = False,
-                         cliPath = getDepthmapXcli()):
+                         cliPath = None):
     if graphFileOut is None:
         graphFileOut = graphFileIn;
     params = [cliPath,
@@ -177,12 +509,12 @@ def axialAnalysis(graphFileIn, graphFileOut = None, radii = ["n"], includeChoice
     if includeIntermediateMetrics:
         params.append("-xar")
         
-    subprocess.check_output(params)
+    runDepthmapXcli(params, "axialAnalysis")
 
 
 def segmentAnalysis(graphFileIn, graphFileOut = None, analysisType = "tulip", radii = ["n"],
                     radiusType = "metric", tulipBins = None, weightWithColumn = None,
-                    includeChoice = False, cliPath = getDepthmapXcli()):
+                    includeChoice = False, cliPath = None):
     if graphFileOut is None:
         graphFileOut = graphFileIn
         
@@ -197,23 +529,26 @@ def segmentAnalysis(graphFileIn, graphFileOut = None, analysisType = "tulip", ra
               "-o", graphFileOut,
               "-m", "SEGMENT",
               "-st", analysisType,
-              "-sr",  ",".join(radii),
-              "-srt", radiusType]
+              "-sr",  ",".join(radii)]
     
-    if includeChoice:
-        params.append("-sic")
-    if tulipBins is not None:
-        params.extend(["-stb", str(tulipBins)])
+    # the cli only takes a radius type, tulip bins and choice for tulip
+    # analysis, the others always include choice
+    if analysisType == "tulip":
+        params.extend(["-srt", radiusType])
+        if includeChoice:
+            params.append("-sic")
+        if tulipBins is not None:
+            params.extend(["-stb", str(tulipBins)])
     if weightWithColumn is not None:
         params.extend(["-swa", str(weightWithColumn)])
     
-    subprocess.check_output(params)
+    runDepthmapXcli(params, "segmentAnalysis")
 
     
     
 
 def createGrid(graphFileIn, graphFileOut = None, gridSize = 0.5,
-                      cliPath = getDepthmapXcli()):
+                      cliPath = None):
     if graphFileOut is None:
         graphFileOut = graphFileIn;
     params = [cliPath,
@@ -222,11 +557,13 @@ def createGrid(graphFileIn, graphFileOut = None, gridSize = 0.5,
               "-m", "VISPREP",
               "-pg", str(gridSize)]
     
-    subprocess.check_output(params)
+    runDepthmapXcli(params)
 
 
 def fillGrid(graphFileIn, graphFileOut = None, fillX = None, fillY = None,
-                    cliPath = getDepthmapXcli()):
+                    cliPath = None):
+    import numpy as np
+    import pandas as pd
     if graphFileOut is None:
         graphFileOut = graphFileIn;
     if fillX is None:
@@ -244,24 +581,24 @@ def fillGrid(graphFileIn, graphFileOut = None, fillX = None, fillY = None,
     if len(fillX) != len(fillY):
         raise ValueError("fillX and fillY must have the same number of coordinates")
         
-    with tempfile.NamedTemporaryFile(suffix='.tsv', delete=False) as tmpPtz:
+    with workspace() as tmpDir:
+        tmpPtz = os.path.join(tmpDir, "points.tsv")
         
         li = np.transpose([fillX, fillY])
         dt = pd.DataFrame(li, columns=['x', 'y'])
-        dt.to_csv(tmpPtz.name, index = False, sep = "\t")
+        dt.to_csv(tmpPtz, index = False, sep = "\t")
 
         params = [cliPath,
                   "-f", graphFileIn,
                   "-o", graphFileOut,
                   "-m", "VISPREP",
-                  "-pf", tmpPtz.name]
+                  "-pf", tmpPtz]
 
-        subprocess.check_output(params)
-        tmpPtz.close()
+        runDepthmapXcli(params)
 
 
 def makeVGAGraph(graphFileIn, graphFileOut = None, maxVisibility = None, boundaryGraph = False,
-                        cliPath = getDepthmapXcli()):
+                        cliPath = None):
     if graphFileOut is None:
         graphFileOut = graphFileIn;
     params = [cliPath,
@@ -274,11 +611,11 @@ def makeVGAGraph(graphFileIn, graphFileOut = None, maxVisibility = None, boundar
     if boundaryGraph:
         params.append("-pb")
 
-    subprocess.check_output(params)
+    runDepthmapXcli(params, "makeVGAGraph")
 
 
 def unmakeVGAGraph(graphFileIn, graphFileOut = None, removeLinks = False,
-                      cliPath = getDepthmapXcli()):
+                      cliPath = None):
     if graphFileOut is None:
         graphFileOut = graphFileIn;
     params = [cliPath,
@@ -290,12 +627,12 @@ def unmakeVGAGraph(graphFileIn, graphFileOut = None, removeLinks = False,
     if removeLinks:
         params.append("-pl")
     
-    subprocess.check_output(params)
+    runDepthmapXcli(params)
 
     
 
 def VGA(graphFileIn, graphFileOut = None, vgaMode = "visibility-global", radii = ["n"],
-               cliPath = getDepthmapXcli()):
+               cliPath = None):
     if graphFileOut is None:
         graphFileOut = graphFileIn;
     if vgaMode not in ["isovist", "visibility-global", "visibility-local",
@@ -315,14 +652,16 @@ def VGA(graphFileIn, graphFileOut = None, vgaMode = "visibility-global", radii =
         params.append("-vg")
     elif vgaMode == "visibility-local":
         params.extend(["-vm", "visibility"])
-        params.append("-local")
+        params.append("-vl")
     
-    subprocess.check_output(params)
+    runDepthmapXcli(params, "VGA")
 
 
 def linkMapCoords(graphFileIn, graphFileOut = None, linkFromX = None, linkFromY = None,
                   linkToX = None, linkToY = None, unlink = False, mapTypeToLink = "pointmaps",
-                  cliPath = getDepthmapXcli()):
+                  cliPath = None):
+    import numpy as np
+    import pandas as pd
     if graphFileOut is None:
         graphFileOut = graphFileIn;
         
@@ -363,11 +702,12 @@ def linkMapCoords(graphFileIn, graphFileOut = None, linkFromX = None, linkFromY
     if mapTypeToLink not in ["pointmaps", "shapegraphs"]:
         raise ValueError("Unknown map type: " + mapTypeToLink)
 
-    with tempfile.NamedTemporaryFile(suffix='.tsv', delete=False) as tmpPtz:
+    with workspace() as tmpDir:
+        tmpPtz = os.path.join(tmpDir, "points.tsv")
         
         li = np.transpose([linkFromX, linkFromY, linkToX, linkToY])
         dt = pd.DataFrame(li, columns=['x1', 'y1', 'x2', 'y2'])
-        dt.to_csv(tmpPtz.name, index = False, sep = "\t")
+        dt.to_csv(tmpPtz, index = False, sep = "\t")
 
         params = [cliPath,
                   "-f", graphFileIn,
@@ -376,16 +716,28 @@ def linkMapCoords(graphFileIn, graphFileOut = None, linkFromX = None, linkFromY
                  "-lmt", mapTypeToLink,
                  "-lm", "unlink" if unlink else "link",
                  "-lt", "coords",
-                 "-lf", tmpPtz.name]
+                 "-lf", tmpPtz]
+
+
+        runDepthmapXcli(params)
 
 
-        subprocess.check_output(params)
-        tmpPtz.close()
+def checkRefs(linkFrom, linkTo):
+    import numpy as np
+    # refs are whole non-negative numbers, and a shape or cell can't be linked to itself
+    refs = np.asarray(list(linkFrom) + list(linkTo))
+    if refs.dtype.kind not in "iuf" or np.any(refs < 0) or np.any(refs != np.floor(refs)):
+        raise ValueError("Refs must be non-negative integers")
+    selfLinks = [str(ref) for ref, other in zip(linkFrom, linkTo) if ref == other]
+    if len(selfLinks) > 0:
+        raise ValueError("Refs can't be linked to themselves: " + ", ".join(selfLinks))
 
 
 def linkMapRefs(graphFileIn, graphFileOut = None, linkFrom = None, linkTo = None,
                 mapTypeToLink = "pointmaps", unlink = False,
-                cliPath = getDepthmapXcli()):
+                cliPath = None):
+    import numpy as np
+    import pandas as pd
     if graphFileOut is None:
         graphFileOut = graphFileIn;
         
@@ -401,17 +753,19 @@ def linkMapRefs(graphFileIn, graphFileOut = None, linkFrom = None, linkTo = None
         raise ValueError("At least one fill location must be provided (linkFrom is empty)")
     if len(linkTo) == 0:
         raise ValueError("At least one fill location must be provided (linkTo is empty)")
-    if len(linkTo) != len(linkTo):
-        raise ValueError("linkFrom and linkTo must have the same number of coordinates")
+    if len(linkFrom) != len(linkTo):
+        raise ValueError("linkFrom and linkTo must have the same number of refs")
+    checkRefs(linkFrom, linkTo)
         
     if mapTypeToLink not in ["pointmaps", "shapegraphs"]:
         raise ValueError("Unknown map type: " + mapTypeToLink)
 
-    with tempfile.NamedTemporaryFile(suffix='.tsv', delete=False) as tmpPtz:
+    with workspace() as tmpDir:
+        tmpPtz = os.path.join(tmpDir, "points.tsv")
         
         li = np.transpose([linkFrom, linkTo])
         dt = pd.DataFrame(li, columns=['reffrom', 'refto'])
-        dt.to_csv(tmpPtz.name, index = False, sep = "\t")
+        dt.to_csv(tmpPtz, index = False, sep = "\t")
 
 
         params = [cliPath,
@@ -421,18 +775,67 @@ def linkMapRefs(graphFileIn, graphFileOut = None, linkFrom = None, linkTo = None
                  "-lmt", mapTypeToLink,
                  "-lm", "unlink" if unlink else "link",
                  "-lt", "refs",
-                 "-lf", tmpPtz.name]
+                 "-lf", tmpPtz]
+
+        runDepthmapXcli(params)
+
+
+
+def makeIsovists(graphFileIn, graphFileOut = None, x = None, y = None, angle = None, viewAngle = None,
+                 cliPath = None):
+    import numpy as np
+    import pandas as pd
+    # angle and viewAngle (degrees) make partial isovists, they have to be
+    # given for all points or for none. The points are passed in a file, so
+    # there is no limit to how many go in one call
+    if graphFileOut is None:
+        graphFileOut = graphFileIn;
+    if x is None or y is None:
+        raise ValueError("At least one isovist location must be provided (x or y is None)")
+    columns = {"x": np.atleast_1d(x), "y": np.atleast_1d(y)}
+    if angle is not None or viewAngle is not None:
+        if angle is None or viewAngle is None:
+            raise ValueError("angle and viewAngle must be provided together")
+        columns["angle"] = np.atleast_1d(angle)
+        columns["viewangle"] = np.atleast_1d(viewAngle)
+    if len(columns["x"]) == 0:
+        raise ValueError("At least one isovist location must be provided (x is empty)")
+    if len(set(len(values) for values in columns.values())) != 1:
+        raise ValueError("x, y, angle and viewAngle must have the same number of values")
+
+    with workspace() as tmpDir:
+        csvPath = os.path.join(tmpDir, "isovists.csv")
+        pd.DataFrame(columns).to_csv(csvPath, index = False)
+        runDepthmapXcli([cliPath,
+                         "-f", graphFileIn,
+                         "-o", graphFileOut,
+                         "-m", "ISOVIST",
+                         "-if", csvPath])
+
+
+def getIsovists(graphFileIn, x, y, angle = None, viewAngle = None, cliPath = None):
+    import numpy as np
+    # isovist polygons, one row per point in the order given. The input graph
+    # is left untouched. Points outside the plan still get a (meaningless) polygon
+    with workspace() as tmpDir:
+        graphFileOut = os.path.join(tmpDir, "isovists.graph")
+        makeIsovists(graphFileIn, graphFileOut, x, y, angle, viewAngle, cliPath)
+        # data maps can't be exported, go through a convex map
+        convertMap(graphFileOut, newMapType = "convex", newMapName = "isovists", cliPath = cliPath)
+        isovists = getShapeGraph(graphFileOut, cliPath)
+    if len(isovists) != len(np.atleast_1d(x)):
+        raise ValueError("Expected " + str(len(np.atleast_1d(x))) + " isovists, got " + str(len(isovists)))
+    isovists = isovists.sort_values("Depthmap_Ref").reset_index(drop = True)
+    return isovists[[isovists.geometry.name]]
+
 
-        subprocess.check_output(params)
-        
-        tmpPtz.close()
 
-        
-        
 def agentAnalysis(graphFileIn, graphFileOut = None, lookMode = "standard", timesteps = 5000,
                   releaseRate = 0.1, agentFOV = 16, agentSteps = 3, agentLife = 500,
                   originX = None, originY = None, locationSeed = 0, numberOfTrails = None,
-                  outputType = "graph", cliPath = getDepthmapXcli()):
+                  outputType = "graph", cliPath = None):
+    import numpy as np
+    import pandas as pd
     if graphFileOut is None:
         graphFileOut = graphFileIn;
         
@@ -454,25 +857,29 @@ def agentAnalysis(graphFileIn, graphFileOut = None, lookMode = "standard", times
               "-afov", str(agentFOV),
               "-asteps", str(agentSteps),
               "-alife", str(agentLife),
-              "-alocseed", str(locationSeed),
               "-ot", outputType]
               
     if numberOfTrails is not None:
-        params.extend(["-atrails", numberOfTrails])
+        params.extend(["-atrails", str(numberOfTrails)])
+
+    # the cli takes either random starting locations (seeds 0 to 10) or a
+    # file of starting points, not both
+    if originX is None:
+        params.extend(["-alocseed", str(locationSeed)])
               
     if originX is not None:
-        with tempfile.NamedTemporaryFile(suffix='.tsv', delete=False) as tmpPtz:
+        with workspace() as tmpDir:
+            tmpPtz = os.path.join(tmpDir, "points.tsv")
             if not isinstance(originX, list):
                 originX = [originX]
             if not isinstance(originY, list):
                 originY = [originY]
             li = np.transpose([originX, originY])
             dt = pd.DataFrame(li, columns=['x', 'y'])
-            dt.to_csv(tmpPtz.name, index = False, sep = "\t")
+            dt.to_csv(tmpPtz, index = False, sep = "\t")
 
             params.extend(["-alocfile", tmpPtz])
-            subprocess.check_output(params)
-            tmpPtz.close()
+            runDepthmapXcli(params, "agentAnalysis")
   
     else:
-        subprocess.check_output(params)
+        runDepthmapXcli(params, "agentAnalysis")
@@ -0,0 +1,655 @@
+import os
+import re
+import shutil
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.sparse import csgraph
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import depthmapXcli as dx
+except ImportError:
+    import depthmapXcli as dx
+
+# In-process axial and segment analysis on the connections exported from a
+# .graph, for quick what-if studies without a depthmapXcli round trip.
+#
+# Shortest paths are computed with scipy's csgraph in batches of origins,
+# spread over a process pool. Tulip segment analysis runs on a directed graph
+# of (segment, direction of travel) states built from the for_back/dir
+# columns of the connections export, so that paths can not turn back on a
+# segment, with turn angles quantised into tulip bins as depthmapX does.
+# Metric analysis measures paths midpoint to midpoint, and topological
+# analysis counts the changes of axial line along them.
+#
+# Within a metric or steps radius depthmapX prunes its tulip search on the
+# path it claimed first to each segment, not the shortest one within the
+# radius, so these radii run a search of their own (see prunedSearch).
+# Radius n and angular radii do not depend on the path and use scipy.
+#
+# Node count, total depth, mean depth and integration follow depthmapX:
+# axial and tulip exactly at any radius, topological exactly and metric
+# within the rounding of depthmapX's metric search (512 bins per longest
+# segment), both at radius n only as the cli runs them. Choice counts one
+# shortest path per pair of elements and breaks ties differently to
+# depthmapX. Use validateAgainstCli to see by how much.
+
+graphContext = None
+
+# segment connection weights are (tulip bins) * hopScale + 1, see segmentStateGraph
+hopScale = 2 ** 20
+
+# width in tulip bins of the depth windows prunedSearch works through
+searchWindow = 16
+
+# slots of the hash prunedSearch finds states open twice with
+claimHashSize = 2 ** 16
+
+noConnection = np.iinfo(np.int64).max // 4
+
+
+def mifColumnName(name):
+    # the column names getShapeGraph returns for a depthmapX attribute
+    return re.sub(r'[^0-9A-Za-z]+', '_', name)
+
+
+def radiusValue(radius):
+    return np.inf if str(radius) == "n" else float(radius)
+
+
+def initWorker(context):
+    global graphContext
+    graphContext = context
+
+
+def treeLevels(hops, pred):
+    # flat indices of the states reached by the shortest path trees, sorted by
+    # their number of steps from the root, and where each step level starts
+    reached = np.flatnonzero((pred >= 0).ravel())
+    reachedHops = hops.ravel()[reached].astype(np.int64)
+    maxHops = reachedHops.max() if reachedHops.size > 0 else 0
+    # numpy radix sorts 16 bit integers
+    order = np.argsort(reachedHops.astype(np.int16) if maxHops < np.iinfo(np.int16).max else reachedHops,
+                       kind = "stable")
+    reached = reached[order]
+    levelStarts = np.searchsorted(reachedHops[order], np.arange(1, maxHops + 2))
+    return reached, levelStarts
+
+
+def addUpTrees(values, reached, levelStarts, parents):
+    # adds the values of every reached state to its parent's, level by level
+    # from the leaves up, so that each ends up with the sum of its subtree
+    for level in range(len(levelStarts) - 2, -1, -1):
+        flat = reached[levelStarts[level]:levelStarts[level + 1]]
+        np.add.at(values, parents[flat], values[flat])
+    return values
+
+
+def analyseBatch(origins):
+    # axial lines, or segments for metric and topological analysis, one
+    # state each
+    ctx = graphContext
+    graph, nElements = ctx["graph"], ctx["nElements"]
+    origins = np.asarray(origins)
+    dist, pred = csgraph.dijkstra(graph, indices = origins, return_predecessors = True,
+                                  unweighted = ctx["unweighted"], limit = ctx["limit"])
+    if ctx["unweighted"]:
+        hops = dist
+    else:
+        # weighted connections carry one hop in their lowest digits (see
+        # segmentStateGraph), which also breaks ties towards fewer steps
+        finite = np.isfinite(dist)
+        hops = np.where(finite, np.mod(dist, hopScale, where = finite, out = np.zeros_like(dist)), np.inf)
+        dist = np.where(finite, np.floor_divide(dist, hopScale, where = finite, out = np.zeros_like(dist)), np.inf)
+    b = len(origins)
+    predFlat = (np.arange(b)[:, None] * nElements + pred).ravel()
+
+    if ctx["includeChoice"]:
+        reached, levelStarts = treeLevels(hops, pred)
+
+    def treeChoice(targets, weights, originWeights):
+        # adds up the weights of the destinations below every element of the
+        # shortest path trees, times the weight of the tree's origin
+        counted = np.zeros(b * nElements)
+        counted[np.flatnonzero(targets)] = weights
+        counted[origins + np.arange(b) * nElements] = 0
+        below = addUpTrees(counted.copy(), reached, levelStarts, predFlat)
+        through = (below - counted).reshape(b, nElements) * originWeights[:, None]
+        # paths do not pass through their own origin
+        through[np.arange(b), origins] = 0
+        return through.sum(axis = 0)
+
+    lengths = ctx["lengths"]
+    elementDepth = dist / ctx["depthScale"]
+    results = []
+    for radius in ctx["radii"]:
+        # radii are in steps (axial), metric and topological segment analyses
+        # only run at radius n
+        inRadius = np.isfinite(dist) & (elementDepth <= radiusValue(radius))
+        measures = {"nodeCount": inRadius.sum(axis = 1),
+                    "totalDepth": np.where(inRadius, elementDepth, 0).sum(axis = 1)}
+        if lengths is not None:
+            measures["totalLength"] = np.where(inRadius, lengths[None, :], 0).sum(axis = 1)
+            measures["weightedDepth"] = np.where(inRadius, elementDepth * lengths[None, :], 0).sum(axis = 1)
+        if ctx["includeChoice"]:
+            targets = inRadius
+            if ctx["pairsOnce"]:
+                # each pair of elements once, from the one with the lower index
+                targets = inRadius & (np.arange(nElements)[None, :] > origins[:, None])
+            measures["choice"] = treeChoice(targets, 1, np.ones(b))
+            if lengths is not None:
+                measures["weightedChoice"] = treeChoice(targets, np.broadcast_to(lengths, targets.shape)[targets],
+                                                        lengths[origins])
+        results.append(measures)
+    return origins, results
+
+
+# measures added up over all origins, the others are per origin
+summedMeasures = ["choice", "weightedChoice"]
+
+
+def runAnalysis(context, processes, batchSize, batchFunction = analyseBatch):
+    # returns a dict of measures per radius
+    nElements = context["nElements"]
+    batches = [np.arange(start, min(start + batchSize, nElements))
+               for start in range(0, nElements, batchSize)]
+    totals = [{} for radius in context["radii"]]
+    if processes == 1:
+        initWorker(context)
+        batchResults = map(batchFunction, batches)
+    else:
+        executor = ProcessPoolExecutor(max_workers = processes, initializer = initWorker,
+                                       initargs = (context,))
+        batchResults = executor.map(batchFunction, batches)
+    for origins, results in batchResults:
+        for k, measures in enumerate(results):
+            for name, values in measures.items():
+                total = totals[k].setdefault(name, np.zeros(nElements))
+                if name in summedMeasures:
+                    total += values
+                else:
+                    total[origins] = values
+    if processes != 1:
+        executor.shutdown()
+    return totals
+
+
+def undefinedToMinusOne(values):
+    # depthmapX writes -1 where a measure is undefined
+    return np.where(np.isfinite(values), values, -1)
+
+
+def connectionIndices(shapeGraph, connections, fromColumn, toColumn):
+    refIndex = pd.Index(shapeGraph["Depthmap_Ref"].values)
+    rows = refIndex.get_indexer(connections[fromColumn].values)
+    cols = refIndex.get_indexer(connections[toColumn].values)
+    if (rows < 0).any() or (cols < 0).any():
+        raise ValueError("Connections refer to refs that are not in the shape graph")
+    return rows, cols
+
+
+def axialAnalysisFromConnections(shapeGraph, connections, radii = ["n"], includeChoice = False,
+                                 processes = None, batchSize = 64):
+    # shapeGraph: output of getShapeGraph, connections: of getShapeGraphConnections
+    rows, cols = connectionIndices(shapeGraph, connections, "refA", "refB")
+    n = len(shapeGraph)
+    graph = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape = (n, n))
+    finiteRadii = [radiusValue(radius) for radius in radii if str(radius) != "n"]
+    context = {"graph": graph, "nElements": n, "unweighted": True, "depthScale": 1,
+               "limit": np.inf if len(finiteRadii) < len(radii) else max(finiteRadii),
+               "radii": radii, "includeChoice": includeChoice, "pairsOnce": False, "lengths": None}
+    totals = runAnalysis(context, processes, batchSize)
+
+    result = pd.DataFrame({"Depthmap_Ref": shapeGraph["Depthmap_Ref"].values})
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        for radius, total in zip(radii, totals):
+            suffix = "" if str(radius) == "n" else " R" + str(radius)
+            nc, td = total["nodeCount"], total["totalDepth"]
+            meanDepth = td / (nc - 1)
+            ra = 2 * (meanDepth - 1) / (nc - 2)
+            dValue = 2 * (nc * (np.log2((nc + 2) / 3) - 1) + 1) / ((nc - 1) * (nc - 2))
+            # like depthmapX, total depth is only written past two nodes
+            measures = {"Node Count": nc,
+                        "Total Depth": np.where(nc > 2, td, np.nan),
+                        "Mean Depth": meanDepth,
+                        "RA": ra,
+                        "RRA": ra / dValue,
+                        "Integration [HH]": dValue / ra}
+            if includeChoice:
+                measures["Choice"] = total["choice"]
+                # normalised by the pairs of elements within the radius of each one
+                measures["Choice [Norm]"] = total["choice"] / ((nc - 1) * (nc - 2) / 2)
+            for name, values in measures.items():
+                result[mifColumnName(name + suffix)] = undefinedToMinusOne(values)
+    return result
+
+
+def segmentStateGraph(shapeGraph, connections, tulipBins):
+    # two states per segment: travelling towards its end (0) or its start (1).
+    # for_back tells which end of refA the connection leaves from and dir the
+    # direction of travel along refB
+    rows, cols = connectionIndices(shapeGraph, connections, "refA", "refB")
+    fromState = rows * 2 + connections["for_back"].values
+    toState = cols * 2 + np.where(connections["dir"].values == 1, 0, 1)
+    # as in depthmapX, a turn of ss_weight right angles costs that many
+    # halves of a ring of tulipBins / 2 + 1 bins, rounded down
+    bins = np.floor(connections["ss_weight"].values * (tulipBins // 2 + 1) / 2)
+    # the angular depth goes in the high digits and a count of steps in the
+    # low ones. This keeps straight (zero angle) connections in the sparse
+    # graph and gives the steps along the paths without walking the trees
+    weights = bins * hopScale + 1
+    n = len(shapeGraph)
+    return scipy.sparse.csr_matrix((weights, (fromState, toState)), shape = (2 * n, 2 * n))
+
+
+def tulipContext(shapeGraph, connections, tulipBins):
+    graph = segmentStateGraph(shapeGraph, connections, tulipBins)
+    nStates = graph.shape[0]
+    toState = graph.indices.astype(np.int64)
+    extra = (graph.data // hopScale).astype(np.int64)
+    # the cheapest connection into each state, the state it comes from and
+    # the next cheapest, for prunedSearch to tell when a state is final
+    order = np.lexsort((extra, toState))
+    sortedFrom = np.repeat(np.arange(nStates), np.diff(graph.indptr))[order]
+    sortedExtra = extra[order]
+    first = np.searchsorted(toState[order], np.arange(nStates))
+    nIn = np.bincount(toState, minlength = nStates)
+    cheapest = np.minimum(first, len(order) - 1)
+    nextCheapest = np.minimum(first + 1, len(order) - 1)
+    lengths = shapeGraph["Segment_Length"].values.astype(np.float64)
+    return {"graph": graph, "indptr": graph.indptr.astype(np.int64), "toState": toState,
+            "extra": extra, "firstIn": np.where(nIn > 0, sortedFrom[cheapest], 0),
+            "minIn": np.where(nIn > 0, sortedExtra[cheapest], noConnection),
+            "nextMinIn": np.where(nIn > 1, sortedExtra[nextCheapest], noConnection),
+            "stateLength": np.repeat(lengths, 2), "nElements": len(shapeGraph),
+            # one unit of angular depth (a right angle) in bins, and the bins
+            # of one unit of angular radius, which depthmapX rounds up by half
+            "depthScale": (tulipBins // 2) / 2, "angularBins": (tulipBins // 2 + 1) / 2}
+
+
+def selectStates(states, index):
+    return {name: values[index] for name, values in states.items()}
+
+
+def joinStates(parts):
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+
+def prunedSearch(ctx, origins, radius):
+    # depthmapX's tulip search within a metric or steps radius. It claims
+    # states by angular and then metric depth, and goes on from a state only
+    # if the path it was claimed by stays within the radius, so the segments
+    # in reach depend on the order they are claimed in. All the origins are
+    # searched at once, in rounds that claim every open state nothing still
+    # open could reach at a lower depth. States past the current window of
+    # depth wait in buckets until every origin gets there
+    indptr, toState, extra = ctx["indptr"], ctx["toState"], ctx["extra"]
+    firstIn, minIn, nextMinIn = ctx["firstIn"], ctx["minIn"], ctx["nextMinIn"]
+    stateLength, radiusType, includeChoice = ctx["stateLength"], ctx["radiusType"], ctx["includeChoice"]
+    nStates = len(indptr) - 1
+    nOrigins = len(origins)
+    claimed = np.zeros(nOrigins * nStates, bool)
+    unreached = np.iinfo(np.int32).max
+    segmentDepth = np.full(nOrigins * nStates // 2, unreached, np.int32)
+
+    # states are keyed by origin and state, and origins start from their
+    # midpoint in both directions
+    states = (np.asarray(origins)[:, None] * 2 + np.arange(2)).ravel()
+    claim = {"key": np.repeat(np.arange(nOrigins) * nStates, 2) + states,
+             "depth": np.zeros(len(states), np.int64),
+             "metric": stateLength[states] / 2}
+    if radiusType == "steps":
+        claim["steps"] = np.zeros(len(states), np.int64)
+    if includeChoice:
+        claim["parent"] = np.full(len(states), -1)
+        claim["id"] = np.arange(len(states))
+    claimed[claim["key"]] = True
+    segmentDepth[claim["key"] // 2] = 0
+    claims = [claim]
+    nClaims = len(states)
+
+    openStates = None
+    waiting, unsorted = {}, []
+    windowEnd = searchWindow
+    hashed = np.zeros(claimHashSize, np.int64)
+    while True:
+        # connections out of the states claimed last, within the radius
+        claimState = claim["key"] % nStates
+        count = indptr[claimState + 1] - indptr[claimState]
+        parent = np.repeat(np.arange(len(claimState)), count)
+        connection = np.arange(len(parent)) + np.repeat(indptr[claimState] - np.cumsum(count) + count, count)
+        child = toState[connection]
+        if radiusType == "metric":
+            within = claim["metric"][parent] + stateLength[child] / 2 <= radius
+        else:
+            within = claim["steps"][parent] < radius
+        key = claim["key"][parent] - claimState[parent] + child
+        within &= ~claimed[key]
+        parent, connection, child = parent[within], connection[within], child[within]
+        reached = {"key": key[within],
+                   "depth": claim["depth"][parent] + extra[connection],
+                   "metric": claim["metric"][parent] + stateLength[child]}
+        if radiusType == "steps":
+            reached["steps"] = claim["steps"][parent] + 1
+        if includeChoice:
+            reached["parent"] = claim["id"][parent]
+
+        inWindow = reached["depth"] < windowEnd
+        parts = [selectStates(reached, inWindow)]
+        if openStates is not None:
+            parts.insert(0, openStates)
+        openStates = joinStates(parts)
+        if not inWindow.all():
+            unsorted.append(selectStates(reached, ~inWindow))
+        openStates = selectStates(openStates, ~claimed[openStates["key"]])
+        while len(openStates["key"]) == 0 and (waiting or unsorted):
+            # on to the next window anything waits in, bucketing what came
+            # past the window since the last one
+            if unsorted:
+                later = joinStates(unsorted)
+                unsorted = []
+                bucket = later["depth"] // searchWindow
+                order = np.argsort(bucket, kind = "stable")
+                splits = np.flatnonzero(np.diff(bucket[order])) + 1
+                for start, part in zip(np.concatenate([[0], splits]), np.split(order, splits)):
+                    waiting.setdefault(bucket[order[start]], []).append(selectStates(later, part))
+            nextBucket = min(waiting)
+            windowEnd = (nextBucket + 1) * searchWindow
+            openStates = joinStates(waiting.pop(nextBucket))
+            openStates = selectStates(openStates, ~claimed[openStates["key"]])
+        if len(openStates["key"]) == 0:
+            break
+
+        key, depth, metric = openStates["key"], openStates["depth"], openStates["metric"]
+        row = key // nStates
+        state = key - row * nStates
+        lowest = np.full(nOrigins, noConnection)
+        np.minimum.at(lowest, row, depth)
+        atLowest = depth == lowest[row]
+        lowestMetric = np.full(nOrigins, np.inf)
+        np.minimum.at(lowestMetric, row[atLowest], metric[atLowest])
+        # a state is final if reaching it from any other open state costs
+        # more than the gap to the lowest depth, through its cheapest
+        # connection in or, when that comes from a claimed state, the next
+        # cheapest. At the lowest depth, going straight on from any other
+        # must be longer
+        costIn = np.where(claimed[key - state + firstIn[state]], nextMinIn[state], minIn[state])
+        final = np.flatnonzero((depth < lowest[row] + costIn) |
+                               (atLowest & (metric <= lowestMetric[row] + stateLength[state])))
+        # a state open more than once keeps its lowest depth, then metric
+        # depth. Hashing the keys finds the few that are without sorting all
+        slot = key[final] & (claimHashSize - 1)
+        position = np.arange(len(final))
+        hashed[slot] = position
+        clashes = slot[hashed[slot] != position]
+        if len(clashes) > 0:
+            clashing = np.zeros(claimHashSize, bool)
+            clashing[clashes] = True
+            shared = clashing[slot]
+            resolved = final[shared]
+            resolved = resolved[np.lexsort((metric[resolved], depth[resolved], key[resolved]))]
+            firstOfKey = np.concatenate([[True], key[resolved][1:] != key[resolved][:-1]])
+            final = np.concatenate([final[~shared], resolved[firstOfKey]])
+
+        claim = selectStates(openStates, final)
+        claimed[claim["key"]] = True
+        np.minimum.at(segmentDepth, claim["key"] // 2, claim["depth"].astype(np.int32))
+        if includeChoice:
+            claim["id"] = nClaims + np.arange(len(final))
+            nClaims += len(final)
+            claims.append(claim)
+
+    segmentDepth = segmentDepth.reshape(nOrigins, -1)
+    inRadius = segmentDepth < unreached
+    measures = {"nodeCount": inRadius.sum(axis = 1),
+                "totalDepth": np.where(inRadius, segmentDepth, 0).sum(axis = 1) / ctx["depthScale"]}
+    if includeChoice:
+        # each segment counts at the claim that reached it first, but not at
+        # the origin. Claims only follow claims of earlier rounds
+        tree = joinStates(claims)
+        segment = tree["key"] // 2
+        first = np.flatnonzero(tree["depth"] == segmentDepth.ravel()[segment])
+        first = first[np.unique(segment[first], return_index = True)[1]]
+        counted = np.zeros(nClaims)
+        counted[first] = 1
+        counted[:len(states)] = 0
+        levelStarts = np.cumsum([0] + [len(part["key"]) for part in claims[1:]])
+        below = addUpTrees(counted.copy(), np.arange(len(states), nClaims), levelStarts, tree["parent"])
+        through = below - counted
+        through[:len(states)] = 0
+        measures["choice"] = np.bincount(tree["key"] % nStates // 2, weights = through,
+                                         minlength = nStates // 2)
+    return measures
+
+
+def tulipShortestPaths(ctx, origins, limits):
+    # radius n and angular radii do not depend on the paths taken, so one
+    # search from both states of each origin covers them all. limits are in
+    # tulip bins
+    graph, includeChoice = ctx["graph"], ctx["includeChoice"]
+    nStates = graph.shape[0]
+    nElements = nStates // 2
+    searchLimit = (np.floor(max(limits)) + 1) * hopScale
+    results = [{"nodeCount": np.zeros(len(origins)), "totalDepth": np.zeros(len(origins))}
+               for limit in limits]
+    if includeChoice:
+        for measures in results:
+            measures["choice"] = np.zeros(nElements)
+    # the trees of this many origins are held at once
+    for start in range(0, len(origins), 32):
+        batch = np.asarray(origins[start:start + 32])
+        dist = np.empty((len(batch), nStates))
+        pred = np.empty((len(batch), nStates), np.int64)
+        for row, origin in enumerate(batch):
+            found = csgraph.dijkstra(graph, indices = [2 * origin, 2 * origin + 1], min_only = True,
+                                     limit = searchLimit, return_predecessors = includeChoice)
+            if includeChoice:
+                # with min_only scipy also returns the source of each path
+                dist[row], pred[row] = found[:2]
+            else:
+                dist[row] = found
+        # the lower of the two states of each element, whose depth is in the
+        # high digits of the distance
+        directions = dist.reshape(len(batch), nElements, 2)
+        best = (directions[:, :, 1] < directions[:, :, 0]).astype(np.int64)
+        elementDepth = np.floor(np.minimum(directions[:, :, 0], directions[:, :, 1]) / hopScale)
+        if includeChoice:
+            finite = np.isfinite(dist)
+            hops = np.where(finite, np.mod(dist, hopScale, where = finite, out = np.zeros_like(dist)), np.inf)
+            reached, levelStarts = treeLevels(hops, pred)
+            predFlat = (np.arange(len(batch))[:, None] * nStates + pred).ravel()
+            bestFlat = (np.arange(len(batch))[:, None] * nStates + np.arange(nElements) * 2 + best).ravel()
+            notOrigin = (np.arange(nElements)[None, :] != batch[:, None]).ravel()
+        for limit, measures in zip(limits, results):
+            inRadius = np.isfinite(elementDepth) & (elementDepth <= limit)
+            measures["nodeCount"][start:start + len(batch)] = inRadius.sum(axis = 1)
+            measures["totalDepth"][start:start + len(batch)] = (np.where(inRadius, elementDepth, 0).sum(axis = 1)
+                                                                / ctx["depthScale"])
+            if includeChoice:
+                counted = np.zeros(len(batch) * nStates)
+                counted[bestFlat[inRadius.ravel() & notOrigin]] = 1
+                through = addUpTrees(counted.copy(), reached, levelStarts, predFlat) - counted
+                # paths do not pass through their own origin
+                through = through.reshape(len(batch), nElements, 2).sum(axis = 2)
+                through[np.arange(len(batch)), batch] = 0
+                measures["choice"] += through.sum(axis = 0)
+    return results
+
+
+def tulipBatch(origins):
+    ctx = graphContext
+    radii, radiusType = ctx["radii"], ctx["radiusType"]
+    results = [None] * len(radii)
+    pathRadii = [k for k, radius in enumerate(radii) if str(radius) == "n" or radiusType == "angular"]
+    if len(pathRadii) > 0:
+        limits = [radiusValue(radii[k]) * ctx["angularBins"] for k in pathRadii]
+        for k, measures in zip(pathRadii, tulipShortestPaths(ctx, origins, limits)):
+            results[k] = measures
+    for k, radius in enumerate(radii):
+        if results[k] is None:
+            results[k] = prunedSearch(ctx, origins, radiusValue(radius))
+    return origins, results
+
+
+def tulipColumnSuffix(radius, radiusType):
+    # as depthmapX names the columns of each radius
+    if str(radius) == "n":
+        return ""
+    value = float(radius)
+    if radiusType == "steps":
+        return " R%d step" % value
+    if radiusType == "angular":
+        return " R%.2f" % value
+    return (" R%.2f metric" if value <= 100 else " R%d metric") % value
+
+
+def segmentElementGraph(shapeGraph, connections, analysisType, lengths):
+    # one state per segment for metric and topological analysis, which
+    # depthmapX runs without a direction of travel. Returns the graph and the
+    # depth of one unit of its weights
+    rows, cols = connectionIndices(shapeGraph, connections, "refA", "refB")
+    n = len(shapeGraph)
+    # segments joined at both ends are listed twice
+    pairs = np.unique(rows.astype(np.int64) * n + cols)
+    rows, cols = pairs // n, pairs % n
+    if analysisType == "metric":
+        # midpoint to midpoint, in steps of 1e-5 of the longest segment so that
+        # the depth fits in the high digits of the weights as for tulip
+        depthScale = 1e5 / lengths.max() if lengths.max() > 0 else 1
+        depths = np.rint((lengths[rows] + lengths[cols]) / 2 * depthScale)
+    else:
+        if "Axial_Line_Ref" not in shapeGraph.columns:
+            raise ValueError("Topological analysis needs the Axial Line Ref of the segments")
+        axialRefs = shapeGraph["Axial_Line_Ref"].values
+        depthScale = 1
+        depths = (axialRefs[rows] != axialRefs[cols]).astype(np.float64)
+    graph = scipy.sparse.csr_matrix((depths * hopScale + 1, (rows, cols)), shape = (n, n))
+    return graph, depthScale
+
+
+def segmentAnalysisFromConnections(shapeGraph, connections, analysisType = "tulip", radii = ["n"],
+                                   radiusType = "metric", tulipBins = 1024, includeChoice = False,
+                                   processes = None, batchSize = None):
+    # the radius type only applies to tulip analysis, as in the cli
+    if analysisType not in ["tulip", "metric", "topological"]:
+        raise ValueError("Unknown segment analysis type: " + analysisType)
+    if radiusType not in ["steps", "metric", "angular"]:
+        raise ValueError("Unknown radius type: " + radiusType)
+    if analysisType != "tulip" and any(str(radius) != "n" for radius in radii):
+        raise ValueError("depthmapX only runs " + analysisType + " segment analysis at radius n")
+    n = len(shapeGraph)
+    result = pd.DataFrame({"Depthmap_Ref": shapeGraph["Depthmap_Ref"].values})
+    if analysisType == "tulip":
+        context = tulipContext(shapeGraph, connections, tulipBins)
+        context.update({"radii": radii, "radiusType": radiusType, "includeChoice": includeChoice})
+        if batchSize is None:
+            # pruned searches take about as long for many origins as for few,
+            # so split the origins evenly over the processes, within 128MB of
+            # claimed states per batch
+            workers = processes or os.cpu_count() or 1
+            batchSize = max(1, min(-(-n // workers), 2 ** 27 // (6 * n)))
+        totals = runAnalysis(context, processes, batchSize, tulipBatch)
+        prefix = "T" + str(tulipBins) + " "
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            for radius, total in zip(radii, totals):
+                suffix = tulipColumnSuffix(radius, radiusType)
+                nc, td = total["nodeCount"], total["totalDepth"]
+                measures = {"Node Count": nc,
+                            "Total Depth": np.where(nc > 1, td, np.nan),
+                            "Mean Depth": td / (nc - 1),
+                            "Integration": nc * nc / td}
+                if includeChoice:
+                    measures["Choice"] = total["choice"]
+                for name, values in measures.items():
+                    result[mifColumnName(prefix + name + suffix)] = undefinedToMinusOne(values)
+        return result
+
+    lengths = shapeGraph.geometry.length.values
+    graph, depthScale = segmentElementGraph(shapeGraph, connections, analysisType, lengths)
+    context = {"graph": graph, "nElements": n, "unweighted": False, "depthScale": depthScale,
+               "limit": np.inf, "radii": ["n"],
+               "includeChoice": includeChoice, "pairsOnce": True, "lengths": lengths}
+    total = runAnalysis(context, processes, batchSize or 32)[0]
+    nc, td = total["nodeCount"], total["totalDepth"]
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        # depthmapX leaves the means of lone segments undefined (NaN) here
+        prefix = analysisType.capitalize() + " "
+        totalLength = total["totalLength"]
+        measures = {"Total Nodes": nc,
+                    "Total Length": totalLength,
+                    "Total Depth": td,
+                    "Mean Depth": td / (nc - 1),
+                    "Mean Depth [SLW]": total["weightedDepth"] / (totalLength - lengths)}
+        if includeChoice:
+            # each pair once, counting the segments at its ends too
+            measures["Choice"] = total["choice"] + nc - 1
+            measures["Choice [SLW]"] = total["weightedChoice"] + lengths * (totalLength - lengths)
+        for name, values in measures.items():
+            result[mifColumnName(prefix + name)] = values
+    return result
+
+
+def axialAnalysisInProcess(graphFileIn, radii = ["n"], includeChoice = False, processes = None,
+                           batchSize = 64, cliPath = None):
+    shapeGraph = dx.getShapeGraph(graphFileIn, cliPath)
+    connections = dx.getShapeGraphConnections(graphFileIn, cliPath)
+    return axialAnalysisFromConnections(shapeGraph, connections, radii, includeChoice,
+                                        processes, batchSize)
+
+
+def segmentAnalysisInProcess(graphFileIn, analysisType = "tulip", radii = ["n"], radiusType = "metric",
+                             tulipBins = 1024, includeChoice = False, processes = None,
+                             batchSize = None, cliPath = None):
+    shapeGraph = dx.getShapeGraph(graphFileIn, cliPath)
+    connections = dx.getShapeGraphConnections(graphFileIn, cliPath)
+    return segmentAnalysisFromConnections(shapeGraph, connections, analysisType, radii, radiusType,
+                                          tulipBins, includeChoice, processes, batchSize)
+
+
+def validateAgainstCli(graphFileIn, mapType = "segment", radii = ["n"], analysisType = "tulip",
+                       radiusType = "metric", tulipBins = 1024, includeChoice = False,
+                       processes = None, cliPath = None):
+    # runs the same analysis with depthmapXcli on a copy of the graph and
+    # compares every column both produce. radiusType and tulipBins are for
+    # segment maps only
+    if mapType not in ["axial", "segment"]:
+        raise ValueError("Unknown map type: " + mapType)
+    with dx.workspace() as tmpDir:
+        graphCopy = os.path.join(tmpDir, "validate.graph")
+        shutil.copyfile(graphFileIn, graphCopy)
+        if mapType == "axial":
+            engine = axialAnalysisInProcess(graphCopy, radii, includeChoice, processes,
+                                            cliPath = cliPath)
+            dx.axialAnalysis(graphCopy, radii = [str(radius) for radius in radii],
+                             includeChoice = includeChoice, includeIntermediateMetrics = True,
+                             cliPath = cliPath)
+        else:
+            engine = segmentAnalysisInProcess(graphCopy, analysisType, radii, radiusType, tulipBins,
+                                              includeChoice, processes, cliPath = cliPath)
+            dx.segmentAnalysis(graphCopy, analysisType = analysisType,
+                               radii = [str(radius) for radius in radii], radiusType = radiusType,
+                               tulipBins = tulipBins, includeChoice = includeChoice, cliPath = cliPath)
+        # the csv export keeps the full attribute names, unlike the mif one
+        csvPath = os.path.join(tmpDir, "validate.csv")
+        dx.export(graphCopy, csvPath, "shapegraph-map-csv", cliPath)
+        cli = pd.read_csv(csvPath).rename(columns = mifColumnName)
+    cli = cli.set_index("Ref").loc[engine["Depthmap_Ref"].values]
+    rows = []
+    for column in engine.columns:
+        if column == "Depthmap_Ref" or column not in cli.columns:
+            continue
+        ours = engine[column].values.astype(np.float64)
+        theirs = cli[column].values.astype(np.float64)
+        # undefined on both sides is a match, on one side only as far off as can be
+        difference = np.abs(ours - theirs)
+        difference[np.isnan(ours) & np.isnan(theirs)] = 0
+        difference[np.isnan(difference)] = np.inf
+        defined = np.isfinite(ours) & np.isfinite(theirs)
+        ours, theirs = ours[defined], theirs[defined]
+        rows.append({"column": column,
+                     "maxAbsDiff": difference.max(),
+                     "maxRelDiff": (difference[defined] / np.maximum(np.abs(theirs), 1e-12)).max()
+                                   if defined.any() else np.nan,
+                     "correlation": np.corrcoef(ours, theirs)[0, 1] if np.std(ours) > 0 and np.std(theirs) > 0 else np.nan})
+    return pd.DataFrame(rows).set_index("column")
@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+try:
+    from . import depthmapXcli as dx
+except ImportError:
+    import depthmapXcli as dx
+
+# Loaders that return the connections of a point map or shape graph as a
+# sparse adjacency matrix, together with an index of the Ref (point maps) or
+# Depthmap_Ref (shape graphs) of each row, in the same order as the rows of
+# getPointmapData and getShapeGraph. Matrices are cached as .npz files next
+# to the graph and rebuilt when the graph changes.
+
+
+def edgeMatrix(refFrom, refTo, refIndex, weights = None, symmetric = False):
+    rows = refIndex.get_indexer(refFrom)
+    cols = refIndex.get_indexer(refTo)
+    if (rows < 0).any() or (cols < 0).any():
+        raise ValueError("Connections refer to refs that are not in the map")
+    if weights is None:
+        weights = np.ones(len(rows), dtype = bool)
+    else:
+        weights = np.asarray(weights, dtype = np.float64)
+    if symmetric:
+        rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+        weights = np.concatenate([weights, weights])
+    matrix = scipy.sparse.csr_matrix((weights, (rows, cols)), shape = (len(refIndex), len(refIndex)))
+    matrix.sort_indices()
+    return matrix
+
+
+def graphStamp(graphFileIn):
+    st = os.stat(graphFileIn)
+    return np.array([st.st_size, st.st_mtime_ns], dtype = np.int64)
+
+
+def matrixCachePath(graphFileIn, name):
+    return graphFileIn + "." + name + ".npz"
+
+
+def loadCachedMatrix(graphFileIn, name):
+    cachePath = matrixCachePath(graphFileIn, name)
+    if not os.path.isfile(cachePath):
+        return None
+    with np.load(cachePath) as npz:
+        if not np.array_equal(npz["stamp"], graphStamp(graphFileIn)):
+            return None
+        matrix = scipy.sparse.csr_matrix((npz["data"], npz["indices"], npz["indptr"]),
+                                         shape = tuple(npz["shape"]))
+        return matrix, pd.Index(npz["refs"], name = str(npz["refName"]))
+
+
+def saveCachedMatrix(graphFileIn, name, matrix, refIndex):
+    np.savez(matrixCachePath(graphFileIn, name),
+             data = matrix.data, indices = matrix.indices, indptr = matrix.indptr,
+             shape = np.array(matrix.shape), refs = refIndex.values,
+             refName = refIndex.name, stamp = graphStamp(graphFileIn))
+
+
+def getPointmapConnectionMatrix(graphFileIn, includeLinks = True, cacheMatrix = True,
+                                cliPath = None):
+    # boolean, symmetric visibility graph. Links made with linkMapCoords or
+    # linkMapRefs are exported separately and are added unless includeLinks is False
+    name = "pointmap-connections" + ("-links" if includeLinks else "")
+    if cacheMatrix:
+        cached = loadCachedMatrix(graphFileIn, name)
+        if cached is not None:
+            return cached
+    refs = dx.getPointmapData(graphFileIn, columns = [], geometry = False, cliPath = cliPath)["Ref"]
+    refIndex = pd.Index(refs, name = "Ref")
+    connections = dx.getPointmapConnections(graphFileIn, cliPath)
+    if includeLinks:
+        links = dx.getPointmapLinks(graphFileIn, cliPath)
+        connections = pd.concat([connections, links[["RefFrom", "RefTo"]]], ignore_index = True)
+    matrix = edgeMatrix(connections["RefFrom"].values, connections["RefTo"].values,
+                        refIndex, symmetric = True)
+    if cacheMatrix:
+        saveCachedMatrix(graphFileIn, name, matrix, refIndex)
+    return matrix, refIndex
+
+
+def getShapeGraphRefs(graphFileIn, cliPath = None):
+    with dx.workspace() as tmpDir:
+        csvPath = os.path.join(tmpDir, "shapegraph.csv")
+        dx.export(graphFileIn, csvPath, "shapegraph-map-csv", cliPath)
+        refs = pd.read_csv(csvPath, usecols = ["Ref"])["Ref"].values
+    return pd.Index(refs, name = "Depthmap_Ref")
+
+
+def getShapeGraphConnectionMatrix(graphFileIn, weightColumn = None, cacheMatrix = True,
+                                  cliPath = None):
+    # connections are exported in both directions. For segment maps
+    # weightColumn may be "ss_weight" (the angular turn between segments),
+    # otherwise the matrix is boolean. Zero weights are kept as explicit entries
+    name = "shapegraph-connections" + ("-" + weightColumn if weightColumn is not None else "")
+    if cacheMatrix:
+        cached = loadCachedMatrix(graphFileIn, name)
+        if cached is not None:
+            return cached
+    refIndex = getShapeGraphRefs(graphFileIn, cliPath)
+    connections = dx.getShapeGraphConnections(graphFileIn, cliPath)
+    weights = None
+    if weightColumn is not None:
+        if weightColumn not in connections.columns:
+            raise ValueError("Unknown connection column: " + weightColumn)
+        weights = connections[weightColumn].values
+    matrix = edgeMatrix(connections["refA"].values, connections["refB"].values, refIndex, weights)
+    if cacheMatrix:
+        saveCachedMatrix(graphFileIn, name, matrix, refIndex)
+    return matrix, refIndex
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+import contextlib
+
+# Per-call measurements of the depthmapXcli runs (wall time, the child's CPU
+# time from its rusage, peak RSS, .graph input and output sizes, mode and
+# parameters) and of the Python side parsing of exports. Enable with
+#
+#   depthmapXcli.setInstrumentation(Instrumentation("runs.jsonl"))
+#
+# Events are appended to a JSON-lines file as they happen, or with
+# traceFormat = "chrome" collected and written as a Chrome trace (viewable in
+# chrome://tracing or Perfetto) on close(). Hooks are called with every event.
+# Runs from asyncDepthmapXcli are reaped by the event loop, which keeps the
+# rusage, so their CPU times and peak RSS are recorded as None.
+
+
+def fileSize(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+def paramValue(params, flag):
+    if flag in params[:-1]:
+        return params[params.index(flag) + 1]
+    return None
+
+
+def maxRSSBytes(rusage):
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    return rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+
+
+def highWaterRSS(pid):
+    # peak RSS of the process image, in bytes, where /proc has it
+    try:
+        with open("/proc/" + str(pid) + "/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def watchHighWaterRSS(pid, done, peak, interval = 0.01):
+    # on linux the child's ru_maxrss also counts the memory of the python
+    # process it was forked from, so follow the cli's own high water mark.
+    # Runs shorter than the interval only get the reading taken at start
+    while not done.wait(interval):
+        value = highWaterRSS(pid)
+        if value is None:
+            break
+        peak[0] = max(peak[0] or 0, value)
+
+
+class Instrumentation:
+
+    def __init__(self, path = None, traceFormat = "jsonl", hooks = None):
+        if traceFormat not in ["jsonl", "chrome"]:
+            raise ValueError("Unknown trace format: " + traceFormat)
+        self.path = path
+        self.traceFormat = traceFormat
+        self.hooks = list(hooks) if hooks is not None else []
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.time()
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def record(self, event):
+        with self.lock:
+            # only the chrome trace is written at the end, jsonl events go out as they happen
+            if self.traceFormat == "chrome":
+                self.events.append(event)
+            elif self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(event) + "\n")
+        for hook in self.hooks:
+            hook(event)
+
+    def recordCli(self, params, start, wallSeconds, returnCode, rusage = None, pid = None,
+                  peakRSS = None, inputBytes = None):
+        # inputBytes is taken before the run, as in place runs overwrite -f
+        if peakRSS is None and rusage is not None:
+            peakRSS = maxRSSBytes(rusage)
+        event = {"kind": "cli",
+                 "name": paramValue(params, "-m"),
+                 "start": start,
+                 "wallSeconds": wallSeconds,
+                 "userSeconds": rusage.ru_utime if rusage is not None else None,
+                 "systemSeconds": rusage.ru_stime if rusage is not None else None,
+                 "maxRSSBytes": peakRSS,
+                 "inputBytes": inputBytes,
+                 "outputBytes": fileSize(paramValue(params, "-o")),
+                 "returnCode": returnCode,
+                 "pid": pid,
+                 "thread": threading.get_ident(),
+                 "params": [str(param) for param in params[1:]]}
+        self.record(event)
+
+    def runCli(self, params):
+        # subprocess.check_output with the child's rusage, where os.wait4 and
+        # os.waitid exist (waitid is missing on macOS before Python 3.13)
+        inputBytes = fileSize(paramValue(params, "-f"))
+        start = time.time()
+        startClock = time.perf_counter()
+        if not hasattr(os, "wait4") or not hasattr(os, "waitid"):
+            try:
+                output = subprocess.check_output(params)
+            except subprocess.CalledProcessError as error:
+                self.recordCli(params, start, time.perf_counter() - startClock, error.returncode,
+                               inputBytes = inputBytes)
+                raise
+            self.recordCli(params, start, time.perf_counter() - startClock, 0,
+                           inputBytes = inputBytes)
+            return output
+        process = subprocess.Popen(params, stdout = subprocess.PIPE)
+        peak = [highWaterRSS(process.pid)]
+        done = threading.Event()
+        watcher = None
+        if peak[0] is not None:
+            watcher = threading.Thread(target = watchHighWaterRSS, args = (process.pid, done, peak),
+                                       daemon = True)
+            watcher.start()
+        output = process.stdout.read()
+        process.stdout.close()
+        # the last reading is taken just before the child exits and is reaped
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        if watcher is not None:
+            done.set()
+            watcher.join()
+            value = highWaterRSS(process.pid)
+            peak[0] = max(peak[0], value) if value is not None else peak[0]
+        _, status, rusage = os.wait4(process.pid, 0)
+        returnCode = os.waitstatus_to_exitcode(status)
+        # the child is reaped already, stop Popen from waiting on it again
+        process.returncode = returnCode
+        self.recordCli(params, start, time.perf_counter() - startClock, returnCode, rusage,
+                       process.pid, peak[0], inputBytes)
+        if returnCode != 0:
+            raise subprocess.CalledProcessError(returnCode, params, output)
+        return output
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        # times a block of Python code, such as parsing an export
+        start = time.time()
+        startClock = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record({"kind": "python",
+                         "name": name,
+                         "start": start,
+                         "wallSeconds": time.perf_counter() - startClock,
+                         "thread": threading.get_ident(),
+                         "args": args})
+
+    def chromeTrace(self):
+        traceEvents = []
+        for event in self.events:
+            args = {key: value for key, value in event.items()
+                    if key not in ["kind", "name", "start", "wallSeconds", "thread"]}
+            traceEvents.append({"name": event["name"] if event["name"] is not None else event["kind"],
+                                "cat": event["kind"],
+                                "ph": "X",
+                                "ts": (event["start"] - self.origin) * 1e6,
+                                "dur": event["wallSeconds"] * 1e6,
+                                "pid": os.getpid(),
+                                "tid": event["thread"],
+                                "args": args})
+        return {"traceEvents": traceEvents, "displayTimeUnit": "ms"}
+
+    def close(self):
+        if self.path is not None and self.traceFormat == "chrome":
+            with self.lock:
+                with open(self.path, "w") as f:
+                    json.dump(self.chromeTrace(), f)
@@ -0,0 +1,282 @@
+import os
+import numpy as np
+import pandas as pd
+import shapely
+
+try:
+    from . import depthmapXcli as dx
+except ImportError:
+    import depthmapXcli as dx
+
+# Link and unlink edits queued and applied together, instead of one LINK run
+# (a full load and save of the .graph) per linkMapCoords/linkMapRefs call:
+#
+#   with LinkSession("barnsbury.graph") as session:
+#       for bridge in bridges:
+#           session.unlinkRefs(bridge.refA, bridge.refB, "shapegraphs")
+#       session.linkCoords(12.1, 30.5, 14.2, 30.5)
+#
+# The edits are flushed when the session closes, and before any other cli run
+# on the graph (an analysis or an export). The cli rejects a whole link file
+# when one of its rows is bad, and crashes on shapegraph refs that don't exist,
+# so all queued edits are validated against the map first and every problem
+# is reported in one ValueError. Edits go in as few LINK runs as the cli
+# allows: one per map type, mode and link type, with pointmap refs turned into
+# cell coordinates so that each pointmap mode takes a single run. Unlinks run
+# before links, so that a link can replace one that is removed.
+
+
+def gridOf(pointMap):
+    # grid size and the centre of cell (0, 0) of a point map
+    x, y, i, j = pointMap["x"], pointMap["y"], pointMap["i"], pointMap["j"]
+    if i.max() > i.min():
+        gridSize = (x.max() - x.min()) / (i.max() - i.min())
+    elif j.max() > j.min():
+        gridSize = (y.max() - y.min()) / (j.max() - j.min())
+    else:
+        # a single column and row, any size puts the points in this cell
+        gridSize = 1.0
+    return gridSize, float(np.median(x - i * gridSize)), float(np.median(y - j * gridSize))
+
+
+def cellRefs(x, y, grid):
+    # the Ref of the cell that contains each point
+    gridSize, originX, originY = grid
+    i = np.rint((np.asarray(x, dtype = float) - originX) / gridSize).astype(np.int64)
+    j = np.rint((np.asarray(y, dtype = float) - originY) / gridSize).astype(np.int64)
+    refs = (i << 16) | j
+    return np.where((i >= 0) & (i <= 0xFFFF) & (j >= 0) & (j <= 0xFFFF), refs, -1)
+
+
+def pairKey(a, b):
+    return (min(a, b), max(a, b))
+
+
+class LinkSession:
+
+    def __init__(self, graphFileIn, graphFileOut = None, validate = True, snapDistance = 1.0,
+                 cliPath = None):
+        # snapDistance: how far from a line the coordinates of a shapegraph
+        # edit may be. The graph is edited in place unless graphFileOut is given
+        if graphFileOut is None:
+            graphFileOut = graphFileIn
+        self.graphFile = graphFileIn
+        self.graphFileOut = graphFileOut
+        self.validateEdits = validate
+        self.snapDistance = snapDistance
+        self.cliPath = cliPath
+        self.edits = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        # an exception in the block drops the edits, they may be half done.
+        # So does a failed flush, the session is gone once the block ends
+        if excType is not None:
+            self.discard()
+            return False
+        try:
+            self.flush()
+        except Exception:
+            self.discard()
+            raise
+        return False
+
+    def linkCoords(self, linkFromX, linkFromY, linkToX, linkToY, mapTypeToLink = "pointmaps"):
+        self.queue("link", "coords", mapTypeToLink, linkFromX, linkFromY, linkToX, linkToY)
+
+    def unlinkCoords(self, linkFromX, linkFromY, linkToX, linkToY, mapTypeToLink = "pointmaps"):
+        self.queue("unlink", "coords", mapTypeToLink, linkFromX, linkFromY, linkToX, linkToY)
+
+    def linkRefs(self, linkFrom, linkTo, mapTypeToLink = "pointmaps"):
+        self.queue("link", "refs", mapTypeToLink, linkFrom, linkTo)
+
+    def unlinkRefs(self, linkFrom, linkTo, mapTypeToLink = "pointmaps"):
+        self.queue("unlink", "refs", mapTypeToLink, linkFrom, linkTo)
+
+    def queue(self, mode, linkType, mapTypeToLink, *values):
+        if mapTypeToLink not in ["pointmaps", "shapegraphs"]:
+            raise ValueError("Unknown map type: " + mapTypeToLink)
+        values = [np.atleast_1d(value) for value in values]
+        if len(values[0]) == 0:
+            raise ValueError("At least one link location must be provided")
+        if len(set(len(value) for value in values)) != 1:
+            raise ValueError("All link coordinates or refs must have the same number of values")
+        if linkType == "refs":
+            dx.checkRefs(values[0], values[1])
+        for row in zip(*[value.tolist() for value in values]):
+            self.edits.append({"mode": mode, "linkType": linkType, "mapType": mapTypeToLink,
+                               "values": tuple(row)})
+        # from now on a cli run on the graph first applies the edits
+        dx.pendingEdits[os.path.abspath(self.graphFileOut)] = self
+
+    def pending(self):
+        return pd.DataFrame([{"mode": edit["mode"], "linkType": edit["linkType"],
+                              "mapType": edit["mapType"], "values": edit["values"]}
+                             for edit in self.edits],
+                            columns = ["mode", "linkType", "mapType", "values"])
+
+    def discard(self):
+        self.edits = []
+        self.unregister()
+
+    def unregister(self):
+        key = os.path.abspath(self.graphFileOut)
+        if dx.pendingEdits.get(key) is self:
+            del dx.pendingEdits[key]
+
+    def validate(self):
+        # returns the problems found with the queued edits, an empty list if
+        # they can all be applied. Pointmap refs are resolved to coordinates
+        self.unregister()
+        try:
+            problems = []
+            for mapType, check in [("pointmaps", self.validatePointmapEdits),
+                                   ("shapegraphs", self.validateShapegraphEdits)]:
+                edits = [edit for edit in self.edits if edit["mapType"] == mapType]
+                if len(edits) > 0:
+                    problems.extend(check(edits))
+            return problems
+        finally:
+            if len(self.edits) > 0:
+                dx.pendingEdits[os.path.abspath(self.graphFileOut)] = self
+
+    def validatePointmapEdits(self, edits):
+        pointMap = dx.getPointmapData(self.graphFile, columns = [], geometry = False, cliPath = self.cliPath)
+        links = dx.getPointmapLinks(self.graphFile, self.cliPath)
+        grid = gridOf(pointMap)
+        filled = set(pointMap["Ref"].tolist())
+        centres = dict(zip(pointMap["Ref"].tolist(), zip(pointMap["x"].tolist(), pointMap["y"].tolist())))
+        # every cell can only be in one link
+        linked = {}
+        for refFrom, refTo in zip(links["RefFrom"].tolist(), links["RefTo"].tolist()):
+            linked[refFrom] = linked[refTo] = pairKey(refFrom, refTo)
+
+        problems = []
+        resolved = []
+        for edit in edits:
+            if edit["linkType"] == "coords":
+                x1, y1, x2, y2 = edit["values"]
+                ends = [(x1, y1), (x2, y2)]
+                refFrom, refTo = cellRefs([x1, x2], [y1, y2], grid).tolist()
+            else:
+                refFrom, refTo = ends = [int(value) for value in edit["values"]]
+            description = "pointmap %s %s %s" % (edit["mode"], edit["linkType"], edit["values"])
+            missing = [str(end) for end, ref in zip(ends, [refFrom, refTo]) if ref not in filled]
+            if len(missing) > 0:
+                problems.append(description + ": not on a filled cell: " + ", ".join(missing))
+                continue
+            if refFrom == refTo:
+                problems.append(description + ": both ends are in the same cell")
+                continue
+            resolved.append((edit, description, refFrom, refTo))
+
+        # unlinks first, as the cli runs them
+        seen = {}
+        for mode in ["unlink", "link"]:
+            for edit, description, refFrom, refTo in resolved:
+                if edit["mode"] != mode:
+                    continue
+                pair = pairKey(refFrom, refTo)
+                if pair in seen:
+                    problems.append(description + ": same cells as " + seen[pair])
+                    continue
+                seen[pair] = description
+                if mode == "unlink":
+                    if linked.get(refFrom) != pair:
+                        problems.append(description + ": the cells are not linked")
+                        continue
+                    del linked[refFrom], linked[refTo]
+                else:
+                    taken = [ref for ref in [refFrom, refTo] if ref in linked]
+                    if len(taken) > 0:
+                        problems.append(description + ": cell already linked: " +
+                                        ", ".join(str(tuple(dx.refIDtoIndex(ref))) for ref in taken))
+                        continue
+                    linked[refFrom] = linked[refTo] = pair
+                # the cli gets coordinates, at the cell centres
+                edit["coords"] = centres[refFrom] + centres[refTo]
+        return problems
+
+    def validateShapegraphEdits(self, edits):
+        shapeGraph = dx.getShapeGraph(self.graphFile, self.cliPath)
+        connections = dx.getShapeGraphConnections(self.graphFile, self.cliPath)
+        refs = shapeGraph["Depthmap_Ref"].to_numpy()
+        known = set(refs.tolist())
+        connected = set(pairKey(a, b) for a, b in zip(connections["refA"].tolist(),
+                                                       connections["refB"].tolist()))
+        lines = shapeGraph.geometry.values
+        tree = shapely.STRtree(lines)
+
+        problems = []
+        seen = {}
+        for edit in edits:
+            description = "shapegraph %s %s %s" % (edit["mode"], edit["linkType"], edit["values"])
+            if edit["linkType"] == "coords":
+                x1, y1, x2, y2 = edit["values"]
+                points = shapely.points([x1, x2], [y1, y2])
+                nearest, distances = tree.query_nearest(points, return_distance = True, all_matches = False)
+                far = [str((x, y)) for (x, y), distance in zip([(x1, y1), (x2, y2)], distances)
+                       if distance > self.snapDistance]
+                if len(far) > 0:
+                    problems.append(description + ": no line within " + str(self.snapDistance) +
+                                    " of " + ", ".join(far))
+                    continue
+                # the nearest lines, the cli may pick another one where lines cross
+                refFrom, refTo = (int(ref) for ref in refs[nearest[1]])
+            else:
+                refFrom, refTo = (int(value) for value in edit["values"])
+                unknown = [str(ref) for ref in [refFrom, refTo] if ref not in known]
+                if len(unknown) > 0:
+                    problems.append(description + ": no such shape: " + ", ".join(unknown))
+                    continue
+            if refFrom == refTo:
+                problems.append(description + ": both ends are on the same shape")
+                continue
+            pair = pairKey(refFrom, refTo)
+            if pair in seen:
+                problems.append(description + ": same shapes as " + seen[pair])
+                continue
+            seen[pair] = description
+            if edit["mode"] == "unlink" and pair not in connected:
+                problems.append(description + ": the shapes are not connected")
+            elif edit["mode"] == "link" and pair in connected:
+                problems.append(description + ": the shapes are already connected")
+        return problems
+
+    def flush(self):
+        # applies the queued edits, raising ValueError with all problems found
+        # if any of them can't be applied (the edits then stay queued)
+        if len(self.edits) == 0:
+            self.unregister()
+            return 0
+        if self.validateEdits:
+            problems = self.validate()
+            if len(problems) > 0:
+                raise ValueError(str(len(problems)) + " of " + str(len(self.edits)) +
+                                 " link edits can't be applied:\n  " + "\n  ".join(problems))
+        groups = {}
+        for edit in self.edits:
+            linkType = "coords" if "coords" in edit else edit["linkType"]
+            groups.setdefault((edit["mode"], edit["mapType"], linkType), []).append(edit)
+        self.unregister()
+        runs = 0
+        for (mode, mapType, linkType), edits in sorted(groups.items(), key = lambda group: group[0][0] == "link"):
+            columns = [list(column) for column in zip(*[edit.get("coords", edit["values"]) for edit in edits])]
+            try:
+                if linkType == "coords":
+                    dx.linkMapCoords(self.graphFile, self.graphFileOut, *columns, unlink = mode == "unlink",
+                                     mapTypeToLink = mapType, cliPath = self.cliPath)
+                else:
+                    dx.linkMapRefs(self.graphFile, self.graphFileOut, *columns, mapTypeToLink = mapType,
+                                   unlink = mode == "unlink", cliPath = self.cliPath)
+            except Exception:
+                # the edits of the runs that failed or didn't happen stay queued
+                dx.pendingEdits[os.path.abspath(self.graphFileOut)] = self
+                raise
+            # later runs edit the output of this one
+            self.graphFile = self.graphFileOut
+            self.edits = [edit for edit in self.edits if not any(edit is done for done in edits)]
+            runs += 1
+        return runs
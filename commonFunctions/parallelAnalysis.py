@@ -0,0 +1,199 @@
+import os
+import shutil
+import itertools
+import statistics
+import shapely
+import geopandas
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import depthmapXcli as dx
+except ImportError:
+    import depthmapXcli as dx
+
+# depthmapXcli runs all radii of an analysis in one single-threaded process.
+# The sweeps below instead run each combination of radius and analysis
+# settings in its own process, on its own copy of the graph, and merge the
+# resulting columns back into a single shapegraph keyed by Depthmap_Ref.
+# Isovists are likewise made in batches of points, each on its own copy,
+# and agent simulations are run once per seed and averaged.
+
+
+def sweepWorker(task):
+    graphFileIn, analysisName, analysisArgs, baseColumns, cliPath = task
+    with dx.workspace() as workDir:
+        graphCopy = os.path.join(workDir, os.path.basename(graphFileIn))
+        shutil.copyfile(graphFileIn, graphCopy)
+        getattr(dx, analysisName)(graphCopy, cliPath = cliPath, **analysisArgs)
+        result = dx.getShapeGraph(graphCopy, cliPath)
+    newColumns = [col for col in result.columns if col not in baseColumns]
+    # only ship back the new measures, the geometry is already known
+    return result[["Depthmap_Ref"] + newColumns]
+
+
+def runSweep(graphFileIn, analysisName, argsList, processes, cliPath):
+    shapeGraph = dx.getShapeGraph(graphFileIn, cliPath)
+    baseColumns = list(shapeGraph.columns)
+    tasks = [(graphFileIn, analysisName, analysisArgs, baseColumns, cliPath)
+             for analysisArgs in argsList]
+    if processes is None:
+        processes = min(len(tasks), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        results = list(executor.map(sweepWorker, tasks))
+
+    shapeGraph = shapeGraph.set_index("Depthmap_Ref", drop = False)
+    for result in results:
+        # radius n produces the same columns whatever the radius type, keep the first
+        newColumns = [col for col in result.columns if col not in shapeGraph.columns]
+        shapeGraph = shapeGraph.join(result.set_index("Depthmap_Ref")[newColumns])
+    return shapeGraph.reset_index(drop = True)
+
+
+def segmentAnalysisSweep(graphFileIn, radii = ["n"], radiusTypes = ["metric"],
+                         analysisTypes = ["tulip"], tulipBins = 1024, weightWithColumn = None,
+                         includeChoice = False, processes = None, cliPath = None):
+    for analysisType in analysisTypes:
+        if analysisType not in ["tulip", "metric", "angular", "topological"]:
+            raise ValueError("Unknown segment analysis type: " + analysisType)
+    for radiusType in radiusTypes:
+        if radiusType not in ["steps", "metric", "angular"]:
+            raise ValueError("Unknown radius type: " + radiusType)
+
+    # the cli runs metric and topological analysis at radius n whatever the
+    # radii, and names the columns without them
+    fixedTypes = [analysisType for analysisType in analysisTypes if analysisType in ["metric", "topological"]]
+    if len(fixedTypes) > 0 and any(str(radius) != "n" for radius in radii):
+        raise ValueError("The cli only runs " + " and ".join(fixedTypes) +
+                         " segment analysis at radius n, sweep them without finite radii")
+
+    argsList = []
+    for analysisType in analysisTypes:
+        # the radius type only applies to tulip analysis
+        typesToRun = radiusTypes if analysisType == "tulip" else radiusTypes[:1]
+        for radiusType, radius in itertools.product(typesToRun, radii):
+            # radius n is the same whatever the radius type, run it only once
+            if str(radius) == "n" and radiusType != typesToRun[0]:
+                continue
+            argsList.append({"analysisType": analysisType,
+                             "radii": [str(radius)],
+                             "radiusType": radiusType,
+                             "tulipBins": tulipBins if analysisType == "tulip" else None,
+                             "weightWithColumn": weightWithColumn,
+                             "includeChoice": includeChoice})
+    return runSweep(graphFileIn, "segmentAnalysis", argsList, processes, cliPath)
+
+
+def axialAnalysisSweep(graphFileIn, radii = ["n"], includeChoice = False, includeLocal = False,
+                       includeIntermediateMetrics = False, processes = None,
+                       cliPath = None):
+    argsList = [{"radii": [str(radius)],
+                 "includeChoice": includeChoice,
+                 "includeLocal": includeLocal,
+                 "includeIntermediateMetrics": includeIntermediateMetrics}
+                for radius in radii]
+    return runSweep(graphFileIn, "axialAnalysis", argsList, processes, cliPath)
+
+
+def isovistWorker(task):
+    graphFileIn, x, y, angle, viewAngle, cliPath = task
+    # the isovists are written to a temporary copy, so batches don't share files
+    return dx.getIsovists(graphFileIn, x, y, angle, viewAngle, cliPath)
+
+
+def isovists(graphFileIn, points, batchSize = 1000, processes = None, cliPath = None):
+    # points: a GeoDataFrame of points or a DataFrame with x and y columns, and
+    # optionally angle and viewangle (degrees) for partial isovists. Returns a
+    # GeoDataFrame with the isovist polygon of every point, indexed like points
+    if isinstance(points, geopandas.GeoDataFrame):
+        x, y = points.geometry.x.values, points.geometry.y.values
+    else:
+        x, y = points["x"].values, points["y"].values
+    angle = points["angle"].values if "angle" in points.columns else None
+    viewAngle = points["viewangle"].values if "viewangle" in points.columns else None
+    if len(x) == 0:
+        raise ValueError("At least one isovist location must be provided (points is empty)")
+
+    batches = [slice(start, start + batchSize) for start in range(0, len(x), batchSize)]
+    tasks = [(graphFileIn, x[batch], y[batch],
+              None if angle is None else angle[batch],
+              None if viewAngle is None else viewAngle[batch], cliPath)
+             for batch in batches]
+    if processes is None:
+        processes = min(len(tasks), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        results = list(executor.map(isovistWorker, tasks))
+
+    result = pd.concat(results, ignore_index = True)
+    result = geopandas.GeoDataFrame(result, geometry = result.geometry.name)
+    result.index = points.index
+    result["Area"] = shapely.area(result.geometry.values)
+    result["Perimeter"] = shapely.length(result.geometry.values)
+    return result
+
+
+def agentWorker(task):
+    graphFileIn, seed, agentArgs, cliPath = task
+    with dx.workspace() as workDir:
+        graphCopy = os.path.join(workDir, os.path.basename(graphFileIn))
+        shutil.copyfile(graphFileIn, graphCopy)
+        dx.agentAnalysis(graphCopy, locationSeed = seed, outputType = "graph",
+                         cliPath = cliPath, **agentArgs)
+        gateCounts = dx.getPointmapData(graphCopy, columns = ["Gate Counts"],
+                                        geometry = False, cliPath = cliPath)
+    return pd.Series(gateCounts["Gate Counts"], index = gateCounts["Ref"])
+
+
+def agentEnsemble(graphFileIn, seeds = range(11), ciHalfWidth = None, confidence = 0.95,
+                  minRuns = 3, processes = None, cliPath = None, **agentArgs):
+    # runs agentAnalysis once per seed and returns the mean and standard
+    # deviation of the gate counts of every cell (indexed by Ref) and the
+    # number of runs used. Runs are folded in seed order and, if ciHalfWidth
+    # is given, the remaining ones are dropped once the confidence interval of
+    # the mean is narrower than +/- ciHalfWidth in every cell.
+    # The cli only takes seeds 0 to 10, and ensembles need them: runs from a
+    # fixed origin (originX/originY) ignore the seed and are all the same
+    seeds = list(seeds)
+    if len(seeds) == 0:
+        raise ValueError("At least one seed must be provided")
+    if agentArgs.get("originX") is not None or agentArgs.get("originY") is not None:
+        raise ValueError("Runs from a fixed origin do not use the seed and are identical, "
+                         "an ensemble needs agents released from random locations")
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    if processes is None:
+        processes = min(len(seeds), os.cpu_count() or 1)
+
+    runs = 0
+    mean = None
+    done = False
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        # a wave of runs at a time, so that no more than one wave is started
+        # past the point where the interval is narrow enough
+        for start in range(0, len(seeds), processes):
+            futures = [executor.submit(agentWorker, (graphFileIn, seed, agentArgs, cliPath))
+                       for seed in seeds[start:start + processes]]
+            for future in futures:
+                gateCounts = future.result()
+                runs += 1
+                # Welford's running mean and sum of squared differences
+                if mean is None:
+                    mean = gateCounts.astype(np.float64)
+                    sqDiff = pd.Series(0.0, index = mean.index)
+                else:
+                    delta = gateCounts - mean
+                    mean += delta / runs
+                    sqDiff += delta * (gateCounts - mean)
+                if ciHalfWidth is not None and runs >= max(minRuns, 2):
+                    std = np.sqrt(sqDiff / (runs - 1))
+                    if (z * std / np.sqrt(runs)).max() < ciHalfWidth:
+                        done = True
+                        break
+            if done:
+                executor.shutdown(cancel_futures = True)
+                break
+
+    std = np.sqrt(sqDiff / (runs - 1)) if runs > 1 else sqDiff * np.nan
+    stats = pd.DataFrame({"Gate Counts Mean": mean, "Gate Counts Std": std})
+    stats.index.name = "Ref"
+    return stats, runs
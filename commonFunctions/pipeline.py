@@ -0,0 +1,219 @@
+import os
+import json
+import pickle
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from . import depthmapXcli as dx
+    from .resultCache import hashFile
+except ImportError:
+    import depthmapXcli as dx
+    from resultCache import hashFile
+
+# Multi-step workflows on a .graph described as a DAG of wrapper calls:
+#
+#   pipeline = Pipeline("checkpoints/barnsbury")
+#   pipeline.addSource("import", dx.importLines, barnsburyAxial)
+#   pipeline.addStep("axial", "import", dx.convertMap, newMapType = "axial", newMapName = "Axial Map")
+#   pipeline.addStep("axialAnalysis", "axial", dx.axialAnalysis, radii = ["n", "3"])
+#   pipeline.addStep("segment", "axial", dx.convertMap, newMapType = "segment",
+#                    newMapName = "Segment Map", stubLengthToRemove = 40)
+#   pipeline.addStep("segmentAnalysis", "segment", dx.segmentAnalysis, radii = ["n", "400"],
+#                    tulipBins = 1024)
+#   pipeline.addRead("segments", "segmentAnalysis", dx.getShapeGraph)
+#   pipeline.addOutput("segmentAnalysis", "data/barnsburySegment.graph")
+#   results = pipeline.run()
+#
+# Steps that follow each other without branching run in place on one graph
+# in a scratch workspace (see depthmapXcli.workspace). Where the DAG branches,
+# each branch continues on its own copy and independent branches run in
+# parallel processes. After every step the graph is checkpointed to the
+# checkpoint directory, together with a signature of the step and all steps
+# before it, so a failed or repeated run resumes after the last step whose
+# checkpoint is still valid. Arguments that are paths to files (a graph to
+# start from) are signed by the contents of the file, not only its path.
+# Outputs are copied out once, at the end.
+
+
+def stepSignature(parentSignature, function, args, kwargs):
+    digest = hashlib.sha256()
+    digest.update((parentSignature or "").encode())
+    digest.update((function.__module__ + "." + function.__qualname__).encode())
+    digest.update(pickle.dumps((args, sorted(kwargs.items()))))
+    for value in list(args) + [value for _, value in sorted(kwargs.items())]:
+        if isinstance(value, str) and os.path.isfile(value):
+            digest.update(hashFile(value).encode())
+    return digest.hexdigest()
+
+
+def runChain(task):
+    # runs a chain of steps on one graph, checkpointing after each one
+    chain, parentGraph, checkpointDir = task
+    with dx.workspace() as scratch:
+        graphFile = os.path.join(scratch, "pipeline.graph")
+        if parentGraph is not None:
+            shutil.copyfile(parentGraph, graphFile)
+        for step in chain:
+            if step["kind"] == "source":
+                step["function"](*step["args"], graphFile, **step["kwargs"])
+            elif step["kind"] == "graph":
+                step["function"](graphFile, *step["args"], **step["kwargs"])
+            else:
+                value = step["function"](graphFile, *step["args"], **step["kwargs"])
+                writeCheckpoint(checkpointDir, step, value = value)
+                continue
+            writeCheckpoint(checkpointDir, step, graphFile = graphFile)
+    return [step["name"] for step in chain]
+
+
+def checkpointPaths(checkpointDir, name):
+    base = os.path.join(checkpointDir, name)
+    return base + ".json", base + ".graph", base + ".pkl"
+
+
+def writeCheckpoint(checkpointDir, step, graphFile = None, value = None):
+    # the data goes first and the signature last, so a checkpoint only counts
+    # once it is complete
+    metaPath, graphPath, valuePath = checkpointPaths(checkpointDir, step["name"])
+    if graphFile is not None:
+        shutil.copyfile(graphFile, graphPath + ".tmp")
+        os.replace(graphPath + ".tmp", graphPath)
+    else:
+        with open(valuePath + ".tmp", "wb") as f:
+            pickle.dump(value, f)
+        os.replace(valuePath + ".tmp", valuePath)
+    with open(metaPath + ".tmp", "w") as f:
+        json.dump({"signature": step["signature"], "kind": step["kind"]}, f)
+    os.replace(metaPath + ".tmp", metaPath)
+
+
+class Pipeline:
+
+    def __init__(self, checkpointDir):
+        self.checkpointDir = checkpointDir
+        self.steps = {}
+        self.outputs = {}
+
+    def addSource(self, name, function, *args, **kwargs):
+        # a step that creates the graph, called as function(*args, graphFile, **kwargs)
+        # (importLines), or a copy of an existing graph when function is a path
+        if isinstance(function, str):
+            args, function = (function,), shutil.copyfile
+        self.addStepOfKind(name, "source", None, function, args, kwargs)
+
+    def addStep(self, name, after, function, *args, **kwargs):
+        # a wrapper that modifies the graph in place, called as
+        # function(graphFile, *args, **kwargs)
+        self.addStepOfKind(name, "graph", after, function, args, kwargs)
+
+    def addRead(self, name, after, function, *args, **kwargs):
+        # a wrapper that reads the graph (getShapeGraph, getPointmapData, ...),
+        # its value is returned by run()
+        self.addStepOfKind(name, "read", after, function, args, kwargs)
+
+    def addOutput(self, name, path):
+        # copy the graph of this step to path at the end of the run
+        if name not in self.steps or self.steps[name]["kind"] == "read":
+            raise ValueError("Unknown graph step: " + name)
+        self.outputs[name] = path
+
+    def addStepOfKind(self, name, kind, after, function, args, kwargs):
+        if name in self.steps:
+            raise ValueError("Step already defined: " + name)
+        parentSignature = None
+        if after is not None:
+            if after not in self.steps or self.steps[after]["kind"] == "read":
+                raise ValueError("Unknown graph step: " + str(after))
+            parentSignature = self.steps[after]["signature"]
+        self.steps[name] = {"name": name, "kind": kind, "after": after, "function": function,
+                            "args": args, "kwargs": kwargs,
+                            "signature": stepSignature(parentSignature, function, args, kwargs)}
+
+    def isDone(self, name):
+        metaPath, graphPath, valuePath = checkpointPaths(self.checkpointDir, name)
+        if not os.path.isfile(metaPath):
+            return False
+        with open(metaPath) as f:
+            if json.load(f)["signature"] != self.steps[name]["signature"]:
+                return False
+        return os.path.isfile(valuePath if self.steps[name]["kind"] == "read" else graphPath)
+
+    def chains(self):
+        # splits the DAG in chains of steps that can run in place on one graph:
+        # a chain continues while its last step has exactly one graph step after
+        # it, and reads go in the chain of the step they read
+        children = {name: [] for name in self.steps}
+        for name, step in self.steps.items():
+            if step["after"] is not None:
+                children[step["after"]].append(name)
+        chains = []
+        starts = [name for name, step in self.steps.items() if step["kind"] == "source"]
+        while len(starts) > 0:
+            name = starts.pop(0)
+            chain = []
+            while True:
+                chain.append(name)
+                graphChildren = [child for child in children[name] if self.steps[child]["kind"] != "read"]
+                chain.extend(child for child in children[name] if self.steps[child]["kind"] == "read")
+                if len(graphChildren) != 1:
+                    starts.extend(graphChildren)
+                    break
+                name = graphChildren[0]
+            chains.append(chain)
+        return chains
+
+    def run(self, processes = None):
+        # returns the graph file (the output path or else the checkpoint) of
+        # every graph step and the value of every read
+        os.makedirs(self.checkpointDir, exist_ok = True)
+        pending = []
+        for chain in self.chains():
+            # resume at the first step without a valid checkpoint, from the
+            # checkpoint of the graph step before it
+            first = 0
+            while first < len(chain) and self.isDone(chain[first]):
+                first += 1
+            if first == len(chain):
+                continue
+            parent = self.steps[chain[0]]["after"]
+            for name in chain[:first]:
+                if self.steps[name]["kind"] != "read":
+                    parent = name
+            pending.append((chain[first:], parent))
+
+        if processes is None:
+            processes = min(max(len(pending), 1), os.cpu_count() or 1)
+        finished = set(name for name in self.steps if self.isDone(name))
+        with ProcessPoolExecutor(max_workers = processes) as executor:
+            running = set()
+            while len(pending) > 0 or len(running) > 0:
+                for remaining, parent in list(pending):
+                    if parent is None or parent in finished:
+                        pending.remove((remaining, parent))
+                        parentGraph = None if parent is None else \
+                            checkpointPaths(self.checkpointDir, parent)[1]
+                        task = ([self.steps[name] for name in remaining], parentGraph, self.checkpointDir)
+                        running.add(executor.submit(runChain, task))
+                if len(running) == 0:
+                    raise ValueError("Steps depend on steps that never run")
+                completed, running = wait(running, return_when = FIRST_COMPLETED)
+                for future in completed:
+                    finished.update(future.result())
+
+        results = {}
+        for name, step in self.steps.items():
+            metaPath, graphPath, valuePath = checkpointPaths(self.checkpointDir, name)
+            if step["kind"] == "read":
+                with open(valuePath, "rb") as f:
+                    results[name] = pickle.load(f)
+            elif name in self.outputs:
+                shutil.copyfile(graphPath, self.outputs[name])
+                results[name] = self.outputs[name]
+            else:
+                results[name] = graphPath
+        return results
+
+    def clear(self):
+        shutil.rmtree(self.checkpointDir, ignore_errors = True)
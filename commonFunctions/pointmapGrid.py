@@ -0,0 +1,166 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    from . import depthmapXcli as dx
+except ImportError:
+    import depthmapXcli as dx
+
+# Point maps are regular grids, every Ref decodes to grid indices (i, j)
+# through refIDtoIndex. PointMapGrid keeps the measures of a point map as
+# dense 2D arrays indexed [j, i] (rows along y, columns along x) with NaN
+# for cells that are not filled, so that maps from different runs on the
+# same grid can be combined with plain array operations.
+
+
+class PointMapGrid:
+
+    def __init__(self, measures, originX, originY, gridSize):
+        # measures: dict of measure name -> 2D array, all of the same shape
+        self.measures = measures
+        self.originX = originX
+        self.originY = originY
+        self.gridSize = gridSize
+
+    @property
+    def shape(self):
+        return next(iter(self.measures.values())).shape
+
+    def __getitem__(self, measure):
+        return self.measures[measure]
+
+    def cellCentres(self):
+        rows, cols = self.shape
+        x = self.originX + np.arange(cols) * self.gridSize
+        y = self.originY + np.arange(rows) * self.gridSize
+        return np.meshgrid(x, y)
+
+    def extent(self):
+        # matplotlib extent (left, right, bottom, top) of the cell edges
+        rows, cols = self.shape
+        half = self.gridSize / 2
+        return (self.originX - half, self.originX + cols * self.gridSize - half,
+                self.originY - half, self.originY + rows * self.gridSize - half)
+
+    def filled(self):
+        return ~np.isnan(next(iter(self.measures.values())))
+
+    def checkAligned(self, other):
+        if not np.isclose(self.gridSize, other.gridSize):
+            raise ValueError("Grids have different grid sizes: " +
+                             str(self.gridSize) + " and " + str(other.gridSize))
+        if not (np.isclose(self.originX, other.originX) and np.isclose(self.originY, other.originY)):
+            raise ValueError("Grids have different origins")
+
+    def difference(self, other, measure, otherMeasure = None):
+        # cell by cell difference between this and another run on the same grid
+        self.checkAligned(other)
+        if otherMeasure is None:
+            otherMeasure = measure
+        a = self.measures[measure]
+        b = other.measures[otherMeasure]
+        rows = max(a.shape[0], b.shape[0])
+        cols = max(a.shape[1], b.shape[1])
+        return padTo(a, rows, cols) - padTo(b, rows, cols)
+
+    def zonalStats(self, zones, measure):
+        # zones: integer array of the grid's shape with a zone label per cell,
+        # negative for cells that are not in any zone
+        values = self.measures[measure]
+        mask = (zones >= 0) & ~np.isnan(values)
+        labels = zones[mask].astype(np.int64)
+        values = values[mask].astype(np.float64)
+        count = np.bincount(labels)
+        total = np.bincount(labels, weights = values)
+        sqTotal = np.bincount(labels, weights = values * values)
+        present = count > 0
+        mean = total[present] / count[present]
+        stats = pd.DataFrame({"count": count[present],
+                              "mean": mean,
+                              "std": np.sqrt(np.maximum(sqTotal[present] / count[present] - mean * mean, 0)),
+                              "sum": total[present].astype(np.float64)},
+                             index = pd.Index(np.flatnonzero(present), name = "zone"))
+        if len(stats) == 0:
+            # no measured cell in any zone
+            return stats.assign(min = pd.Series(dtype = np.float64), max = pd.Series(dtype = np.float64))
+        sortedValues = values[np.argsort(labels, kind = "stable")]
+        starts = np.concatenate([[0], np.cumsum(count[present])[:-1]])
+        stats["min"] = np.minimum.reduceat(sortedValues, starts)
+        stats["max"] = np.maximum.reduceat(sortedValues, starts)
+        return stats
+
+    def plot(self, measure, ax = None, **kwargs):
+        import matplotlib.pyplot as plt
+        if ax is None:
+            ax = plt.gca()
+        return ax.imshow(self.measures[measure], origin = "lower", extent = self.extent(),
+                         interpolation = "nearest", **kwargs)
+
+    def save(self, directory):
+        # all measures go in one (measure, row, column) stack so that it can be
+        # memory mapped in one go when loading
+        os.makedirs(directory, exist_ok = True)
+        names = list(self.measures)
+        dtype = np.result_type(*[self.measures[name].dtype for name in names])
+        stack = np.lib.format.open_memmap(os.path.join(directory, "measures.npy"), mode = "w+",
+                                          dtype = dtype, shape = (len(names),) + self.shape)
+        for k, name in enumerate(names):
+            stack[k] = self.measures[name]
+        stack.flush()
+        del stack
+        with open(os.path.join(directory, "grid.json"), "w") as f:
+            json.dump({"measures": names,
+                       "originX": self.originX,
+                       "originY": self.originY,
+                       "gridSize": self.gridSize}, f)
+
+    @classmethod
+    def load(cls, directory, mmapMode = "r"):
+        with open(os.path.join(directory, "grid.json")) as f:
+            meta = json.load(f)
+        stack = np.load(os.path.join(directory, "measures.npy"), mmap_mode = mmapMode)
+        measures = {name: stack[k] for k, name in enumerate(meta["measures"])}
+        return cls(measures, meta["originX"], meta["originY"], meta["gridSize"])
+
+
+def padTo(values, rows, cols):
+    if values.shape == (rows, cols):
+        return values
+    padded = np.full((rows, cols), np.nan, dtype = values.dtype)
+    padded[:values.shape[0], :values.shape[1]] = values
+    return padded
+
+
+def pointMapToGrid(pointMap, gridSize, columns = None, dtype = np.float32):
+    # pointMap: the output of processPointMap/getPointmapData, either a
+    # GeoDataFrame or the dict of arrays returned with geometry = False.
+    # gridSize is the one the grid was created with (createGrid)
+    if isinstance(pointMap, dict):
+        x, y = pointMap['x'], pointMap['y']
+        available = [col for col in pointMap if col not in ["Ref", "i", "j", "x", "y"]]
+    else:
+        x, y = pointMap.geometry.x.values, pointMap.geometry.y.values
+        available = [col for col in pointMap.columns
+                     if col not in ["Ref", "i", "j", pointMap.geometry.name]]
+    if columns is None:
+        columns = available
+    i, j = dx.refIDtoIndex(np.asarray(pointMap['Ref']))
+    # the grid origin is the centre of cell (0, 0)
+    originX = float(np.median(x - i * gridSize))
+    originY = float(np.median(y - j * gridSize))
+    shape = (int(j.max()) + 1, int(i.max()) + 1)
+    measures = {}
+    for col in columns:
+        grid = np.full(shape, np.nan, dtype = dtype)
+        grid[j, i] = np.asarray(pointMap[col])
+        measures[col] = grid
+    return PointMapGrid(measures, originX, originY, gridSize)
+
+
+def getPointmapGrid(graphFileIn, gridSize, columns = None, dtype = np.float32,
+                    cliPath = None):
+    pointMap = dx.getPointmapData(graphFileIn, columns = columns, downcast = dtype == np.float32,
+                                  geometry = False, cliPath = cliPath)
+    return pointMapToGrid(pointMap, gridSize, columns, dtype)
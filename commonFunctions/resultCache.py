@@ -0,0 +1,147 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+# On-disk cache of depthmapXcli results. Each entry is keyed by a hash of
+# everything that determines the output of a run: the wrapper name, the
+# bytes of the input .graph, the normalised parameter list (with any
+# auxiliary input files replaced by the hash of their contents) and the
+# depthmapXcli binary itself. An entry holds copies of the files the run
+# produced (the output .graph, or exported tables such as a .mif/.mid pair)
+# so a hit can restore them without running the cli.
+
+binaryHashes = {}
+
+
+def hashFile(filePath, chunkSize = 1 << 20):
+    digest = hashlib.sha256()
+    with open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hashBinary(cliPath):
+    # the binary rarely changes, so only rehash it when its size or
+    # modification time does
+    st = os.stat(cliPath)
+    statKey = (os.path.abspath(cliPath), st.st_size, st.st_mtime_ns)
+    if statKey not in binaryHashes:
+        binaryHashes[statKey] = hashFile(cliPath)
+    return binaryHashes[statKey]
+
+
+def outputFiles(fileOut):
+    # mif exports are written as a .mif/.mid pair
+    root, ext = os.path.splitext(fileOut)
+    if ext.lower() == ".mif":
+        return [fileOut, root + ".mid"]
+    return [fileOut]
+
+
+class ResultCache:
+
+    def __init__(self, cacheDir, maxBytes = 10 * (1 << 30)):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cacheDir, exist_ok = True)
+
+    def makeKey(self, name, params):
+        # params is the full command line, starting with the cli path
+        digest = hashlib.sha256()
+        digest.update(name.encode('utf-8'))
+        digest.update(hashBinary(params[0]).encode('utf-8'))
+        previous = None
+        for param in params[1:]:
+            param = str(param)
+            value = param
+            if previous == "-o":
+                # only the type of the output matters, not where it goes
+                value = os.path.splitext(param)[1].lower()
+            elif previous == "-f" or os.path.isfile(param):
+                value = hashFile(param)
+            digest.update(b'\0' + value.encode('utf-8'))
+            previous = param
+        return digest.hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def restore(self, key, fileOut):
+        entry = self.entryPath(key)
+        metaPath = os.path.join(entry, "meta.json")
+        if not os.path.isfile(metaPath):
+            self.misses += 1
+            return False
+        with open(metaPath) as f:
+            meta = json.load(f)
+        targets = outputFiles(fileOut)
+        if len(targets) != len(meta["files"]):
+            self.misses += 1
+            return False
+        for cached, target in zip(meta["files"], targets):
+            shutil.copyfile(os.path.join(entry, cached), target)
+        # mark as recently used for the eviction order
+        os.utime(entry)
+        self.hits += 1
+        return True
+
+    def store(self, key, fileOut):
+        entry = self.entryPath(key)
+        os.makedirs(os.path.dirname(entry), exist_ok = True)
+        staging = tempfile.mkdtemp(dir = os.path.dirname(entry))
+        files = []
+        for i, produced in enumerate(outputFiles(fileOut)):
+            if not os.path.isfile(produced):
+                shutil.rmtree(staging)
+                return
+            files.append(str(i))
+            shutil.copyfile(produced, os.path.join(staging, str(i)))
+        with open(os.path.join(staging, "meta.json"), "w") as f:
+            json.dump({"files": files}, f)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.replace(staging, entry)
+        self.evict()
+
+    def entries(self):
+        result = []
+        for bucket in os.listdir(self.cacheDir):
+            bucketPath = os.path.join(self.cacheDir, bucket)
+            if not os.path.isdir(bucketPath):
+                continue
+            for key in os.listdir(bucketPath):
+                entry = os.path.join(bucketPath, key)
+                if not os.path.isfile(os.path.join(entry, "meta.json")):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                result.append((os.path.getmtime(entry), size, entry))
+        return result
+
+    def evict(self):
+        # drop least recently used entries until the cache fits in maxBytes
+        entries = sorted(self.entries())
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if totalSize <= self.maxBytes:
+                break
+            shutil.rmtree(entry, ignore_errors = True)
+            totalSize -= size
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors = True)
+
+    def stats(self):
+        entries = self.entries()
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries)}
@@ -0,0 +1,113 @@
+import os
+import json
+import geopandas
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    from .resultCache import hashFile
+except ImportError:
+    from resultCache import hashFile
+
+# GeoParquet copies of the tables read back from a .graph (getShapeGraph,
+# getPointmapData), so that reading the results of an analysis again does
+# not export and parse the MIF/MID or csv each time. Enable with
+#
+#   depthmapXcli.setResultStore(ResultStore())
+#
+# Tables are kept next to the graph (barnsbury.graph.shapegraph.parquet) or
+# in storeDir, with geometry as WKB and the measures as typed columns. Each
+# file is tagged with the sha256 of the graph it was read from, and only
+# used while the graph is unchanged: a graph with the size and modification
+# time it had is taken as is, otherwise it is rehashed. Reads are memory
+# mapped and only load the requested columns.
+
+graphHashKey = b"depthmapx:graph_sha256"
+graphStatKey = b"depthmapx:graph_stat"
+
+
+def graphStat(graphFile):
+    st = os.stat(graphFile)
+    return "%d %d" % (st.st_size, st.st_mtime_ns)
+
+
+def geoMetadata(gdf):
+    # GeoParquet 1.0 file metadata for the (single) WKB geometry column
+    name = gdf.geometry.name
+    column = {"encoding": "WKB",
+              "geometry_types": sorted(gdf.geom_type.dropna().unique().tolist())}
+    if gdf.crs is not None:
+        column["crs"] = gdf.crs.to_json_dict()
+    if len(gdf) > 0:
+        column["bbox"] = [float(value) for value in gdf.total_bounds]
+    return {"version": "1.0.0", "primary_column": name, "columns": {name: column}}
+
+
+class ResultStore:
+
+    def __init__(self, storeDir = None):
+        self.storeDir = storeDir
+        self.hits = 0
+        self.misses = 0
+        if storeDir is not None:
+            os.makedirs(storeDir, exist_ok = True)
+
+    def path(self, graphFile, table):
+        if self.storeDir is None:
+            return graphFile + "." + table + ".parquet"
+        # one file per graph path in the store directory
+        name = os.path.abspath(graphFile).strip(os.sep).replace(os.sep, "_")
+        return os.path.join(self.storeDir, name + "." + table + ".parquet")
+
+    def isCurrent(self, graphFile, metadata):
+        if metadata is None or graphHashKey not in metadata:
+            return False
+        if metadata.get(graphStatKey) == graphStat(graphFile).encode():
+            return True
+        return metadata[graphHashKey] == hashFile(graphFile).encode()
+
+    def load(self, graphFile, table, columns = None):
+        # the stored table as a GeoDataFrame, or None if there is none for the
+        # graph as it is now. columns: only load these measures (the
+        # geometry and the columns in keepColumns are always loaded)
+        path = self.path(graphFile, table)
+        if not os.path.isfile(path):
+            self.misses += 1
+            return None
+        schema = pq.read_schema(path, memory_map = True)
+        if not self.isCurrent(graphFile, schema.metadata):
+            self.misses += 1
+            return None
+        if columns is not None:
+            geo = json.loads(schema.metadata[b"geo"])
+            keep = json.loads(schema.metadata.get(b"depthmapx:keep_columns", b"[]"))
+            missing = [col for col in columns if col not in schema.names]
+            if len(missing) > 0:
+                raise ValueError("Columns not found in stored " + table + ": " + ", ".join(missing))
+            columns = [name for name in schema.names
+                       if name in columns or name in keep or name == geo["primary_column"]]
+        data = pq.read_table(path, columns = columns, memory_map = True)
+        self.hits += 1
+        return geopandas.GeoDataFrame.from_arrow(data)
+
+    def save(self, graphFile, table, gdf, keepColumns = ()):
+        # keepColumns: columns loaded along with any column selection (such as
+        # the refs that identify the rows)
+        metadata = {b"geo": json.dumps(geoMetadata(gdf)).encode(),
+                    b"depthmapx:keep_columns": json.dumps(list(keepColumns)).encode(),
+                    graphHashKey: hashFile(graphFile).encode(),
+                    graphStatKey: graphStat(graphFile).encode()}
+        data = pa.table(gdf.to_arrow(index = False, geometry_encoding = "WKB"))
+        data = data.replace_schema_metadata(metadata)
+        path = self.path(graphFile, table)
+        pq.write_table(data, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def clear(self, graphFile):
+        for table in ["shapegraph", "pointmap"]:
+            path = self.path(graphFile, table)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
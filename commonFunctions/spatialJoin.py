@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import shapely
+import scipy.sparse
+
+# Bulk attribution of points (VGA cells, gate counts, snapshot points) to
+# polygons (rooms, isovists) with one query against a spatial index of the
+# polygons, instead of intersecting the points with every polygon in turn.
+
+
+def pointPolygonMembership(pointsDF, polysDF, predicate = "intersects"):
+    # sparse (points x polygons) boolean matrix, True where the point is
+    # found in the polygon. Rows and columns follow the row order of the
+    # two frames
+    tree = shapely.STRtree(polysDF.geometry.values)
+    pointIdx, polyIdx = tree.query(pointsDF.geometry.values, predicate = predicate)
+    membership = scipy.sparse.csr_matrix((np.ones(len(pointIdx), dtype = bool), (pointIdx, polyIdx)),
+                                         shape = (len(pointsDF), len(polysDF)))
+    membership.sort_indices()
+    return membership
+
+
+def pointsOverPolys(pointsDF, polysDF, predicate = "intersects"):
+    # returns a frame aligned with pointsDF with the attributes of the polygon
+    # each point is found in (the first one, in polysDF order, if it is in
+    # several and NaN if it is in none) and the full membership matrix
+    membership = pointPolygonMembership(pointsDF, polysDF, predicate)
+    # indices are sorted within each row, so the first entry per row is the first polygon
+    hasPoly = np.diff(membership.indptr) > 0
+    firstPoly = np.full(len(pointsDF), -1, dtype = np.int64)
+    firstPoly[hasPoly] = membership.indices[membership.indptr[:-1][hasPoly]]
+    attributes = pd.DataFrame(polysDF.drop(columns = polysDF.geometry.name))
+    attributes = attributes.iloc[firstPoly[hasPoly]]
+    attributes.index = pointsDF.index[hasPoly]
+    return attributes.reindex(pointsDF.index), membership
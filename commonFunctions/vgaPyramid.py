@@ -0,0 +1,171 @@
+import os
+import shapely
+import geopandas
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import depthmapXcli as dx
+    from .vgaTiles import planGraph, gridLayout, gridOrigin, clipPlan
+    from .pointmapGrid import pointMapToGrid
+except ImportError:
+    import depthmapXcli as dx
+    from vgaTiles import planGraph, gridLayout, gridOrigin, clipPlan
+    from pointmapGrid import pointMapToGrid
+
+# Coarse to fine VGA: the whole plan at a coarse grid first, then only
+# selected areas at finer grids, level by level:
+#
+#   for gridSize, pointMap in vgaPyramid(planLines, [0.5, 0.2, 0.05], 12.1, 30.5,
+#                                        measure = "Visual Integration [HH]"):
+#       plot(pointMap)
+#
+# The areas refined at each level are the regions given (polygons, the same
+# at every level), or else the cells of the previous level where the
+# measure changes most from cell to cell (the top refineFraction of them).
+# Each area is cut out of the plan, closed with a wall on its outline and
+# analysed on its own, in parallel, so the measures of refined cells are
+# those of the area and not of the whole plan: global measures such as
+# integration are relative to the area.
+#
+# Cells keep the Ref they would have on a grid of the whole plan at their
+# size (from a cheap fill of the whole plan, see vgaTiles.gridLayout), and
+# parentRef is the Ref of the cell of the previous level that contains them,
+# for the cell indices of both levels (refIDtoIndex). A fine cell centre on
+# the edge between two coarse cells goes to the one above or to the right.
+# Next to walls the parent may be a cell the previous level didn't fill.
+
+
+def parentRefs(x, y, parentGrid):
+    gridSize, originX, originY = parentGrid
+    i = np.floor((x - originX) / gridSize + 0.5).astype(np.int64)
+    j = np.floor((y - originY) / gridSize + 0.5).astype(np.int64)
+    return (i << 16) | j
+
+
+def gradientMagnitude(pointMap, gridSize, measure):
+    # the largest difference of the measure to any of the 4 next cells
+    grid = pointMapToGrid(pointMap, gridSize, [measure], np.float64)
+    values = np.pad(grid[measure], 1, constant_values = np.nan)
+    centre = values[1:-1, 1:-1]
+    differences = np.stack([np.abs(centre - values[:-2, 1:-1]), np.abs(centre - values[2:, 1:-1]),
+                            np.abs(centre - values[1:-1, :-2]), np.abs(centre - values[1:-1, 2:])])
+    with np.errstate(all = "ignore"):
+        magnitude = np.fmax.reduce(differences, axis = 0)
+    i, j = dx.refIDtoIndex(np.asarray(pointMap["Ref"]))
+    return magnitude[j, i]
+
+
+def refineAreas(pointMap, gridSize, measure, refineFraction):
+    # the cells with the steepest change of the measure and those next to
+    # them, merged into polygons
+    magnitude = gradientMagnitude(pointMap, gridSize, measure)
+    finite = np.isfinite(magnitude)
+    if not finite.any():
+        return []
+    threshold = np.quantile(magnitude[finite], 1 - refineFraction)
+    steep = finite & (magnitude >= threshold) & (magnitude > 0)
+    x = pointMap.geometry.x.values[steep]
+    y = pointMap.geometry.y.values[steep]
+    reach = 1.5 * gridSize
+    cells = shapely.box(x - reach, y - reach, x + reach, y + reach)
+    return list(shapely.get_parts(shapely.union_all(cells)))
+
+
+def regionWorker(task):
+    regionLines, fillX, fillY, gridSize, vgaMode, radii, maxVisibility, cliPath = task
+    with dx.workspace() as tmpDir:
+        graphFile = os.path.join(tmpDir, "region.graph")
+        planGraph(regionLines, graphFile, gridSize, fillX, fillY, cliPath)
+        dx.makeVGAGraph(graphFile, maxVisibility = maxVisibility, cliPath = cliPath)
+        dx.VGA(graphFile, vgaMode = vgaMode, radii = radii, cliPath = cliPath)
+        return pd.DataFrame(dx.getPointmapData(graphFile, geometry = False, cliPath = cliPath))
+
+
+def analyseRegions(lineMap, regions, layout, gridSize, vgaMode, radii, maxVisibility, processes, cliPath):
+    # VGA of each region on its own, stitched onto the cells of the whole plan
+    tasks = []
+    for region in regions:
+        # fill from the cells of the whole plan in the region, keeping off the outline
+        inner = region.buffer(-gridSize)
+        inside = shapely.contains_xy(inner, layout["x"].values, layout["y"].values)
+        if not inside.any():
+            continue
+        tasks.append((clipPlan(lineMap, region), layout["x"][inside].tolist(), layout["y"][inside].tolist(),
+                      gridSize, vgaMode, radii, maxVisibility, cliPath))
+    if len(tasks) == 0:
+        return None
+    if processes is None:
+        processes = min(len(tasks), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        results = list(executor.map(regionWorker, tasks))
+
+    originX, originY = gridOrigin(layout, gridSize)
+    result = pd.concat(results, ignore_index = True)
+    i = np.rint((result["x"].values - originX) / gridSize).astype(np.int64)
+    j = np.rint((result["y"].values - originY) / gridSize).astype(np.int64)
+    result = result.assign(Ref = (i << 16) | j, i = i, j = j)
+    # where regions overlap keep the cell of the first one
+    return result.drop_duplicates("Ref").sort_values("Ref").reset_index(drop = True)
+
+
+def toPointMap(result, parentGrid):
+    measures = [col for col in result.columns if col not in ["Ref", "i", "j", "x", "y"]]
+    pointMap = result[["Ref"] + measures].assign(i = result["i"], j = result["j"])
+    if parentGrid is not None:
+        pointMap = pointMap.assign(parentRef = parentRefs(result["x"].values, result["y"].values, parentGrid))
+    pointMap = geopandas.GeoDataFrame(pointMap, geometry = geopandas.points_from_xy(result["x"], result["y"]))
+    return pointMap.rename_geometry("coords")
+
+
+def vgaPyramid(lineMap, gridSizes, fillX, fillY, vgaMode = "visibility-global", radii = ["n"],
+               measure = None, regions = None, refineFraction = 0.1, maxVisibility = None,
+               processes = None, cliPath = None):
+    # yields (gridSize, pointMap) for each level as soon as it is done, the
+    # first with all cells of the plan at gridSizes[0], the others with only
+    # the refined cells. measure picks the refined areas when no regions are
+    # given (polygons, or a GeoSeries/GeoDataFrame of them)
+    gridSizes = list(gridSizes)
+    if len(gridSizes) == 0:
+        raise ValueError("At least one grid size must be provided")
+    if any(finer >= coarser for coarser, finer in zip(gridSizes, gridSizes[1:])):
+        raise ValueError("Grid sizes must go from coarse to fine")
+    if len(gridSizes) > 1 and regions is None and measure is None:
+        raise ValueError("Either regions or a measure to refine by must be provided")
+    if not 0 < refineFraction <= 1:
+        raise ValueError("refineFraction must be in (0, 1]")
+    if not isinstance(fillX, list):
+        fillX = [fillX]
+    if not isinstance(fillY, list):
+        fillY = [fillY]
+    if regions is not None:
+        if isinstance(regions, (geopandas.GeoDataFrame, geopandas.GeoSeries)):
+            regions = regions.geometry.values
+        regions = [part for region in regions for part in shapely.get_parts(region)]
+
+    # the coarsest level is the whole plan as it is
+    with dx.workspace() as tmpDir:
+        graphFile = os.path.join(tmpDir, "coarse.graph")
+        planGraph(lineMap, graphFile, gridSizes[0], fillX, fillY, cliPath)
+        dx.makeVGAGraph(graphFile, maxVisibility = maxVisibility, cliPath = cliPath)
+        dx.VGA(graphFile, vgaMode = vgaMode, radii = radii, cliPath = cliPath)
+        pointMap = dx.getPointmapData(graphFile, cliPath = cliPath)
+    if measure is not None and measure not in pointMap.columns:
+        raise ValueError("Measure not found in point map: " + measure)
+    yield gridSizes[0], pointMap
+
+    for parentSize, gridSize in zip(gridSizes, gridSizes[1:]):
+        areas = regions if regions is not None else refineAreas(pointMap, parentSize, measure, refineFraction)
+        if len(areas) == 0:
+            return
+        layout = gridLayout(lineMap, gridSize, fillX, fillY, cliPath)
+        parentGrid = (parentSize,) + tuple(gridOrigin(
+            pd.DataFrame({"x": pointMap.geometry.x.values, "y": pointMap.geometry.y.values,
+                          "i": pointMap["i"].values, "j": pointMap["j"].values}), parentSize))
+        result = analyseRegions(lineMap, areas, layout, gridSize, vgaMode, radii, maxVisibility,
+                                processes, cliPath)
+        if result is None:
+            return
+        pointMap = toPointMap(result, parentGrid)
+        yield gridSize, pointMap
@@ -0,0 +1,197 @@
+import os
+import shapely
+import geopandas
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import depthmapXcli as dx
+except ImportError:
+    import depthmapXcli as dx
+
+# VGA of large plans in tiles. The visibility graph of a whole plan grows
+# with the number of visible pairs of cells, so fine grids over large plans
+# run out of memory in one process. Measures that only depend on a bounded
+# neighbourhood can instead be computed tile by tile:
+#
+#   tiledVGA(planLines, gridSize = 0.1, fillX = 12.1, fillY = 30.5,
+#            radius = 10, vgaMode = "visibility-local")
+#
+# Each tile is cut out of the plan together with a halo around it, closed
+# with a wall at the edge of the halo, gridded and filled at the cells the
+# whole plan has there, and analysed with its visibility limited to radius
+# (makeVGAGraph(maxVisibility = radius)) in a process of its own. Only the
+# cells of the tile itself are kept, with the Ref they have on the grid of
+# the whole plan: depthmapX grids are aligned to multiples of the grid size,
+# so the cells of all tiles fall on the same grid.
+#
+# The halo is the reach of the measure: radius for connectivity, twice the
+# radius for visibility-local, which uses the neighbours of neighbours.
+# Isovists are not limited by maxVisibility but reach as far as the plan
+# lets them see, so they can't be tiled.
+#
+# depthmapX places the grid from the lower left corner of the drawing, which
+# the wall around a tile moves. The cells stay where they are, but their
+# coordinates are rounded differently, and whether two cells exactly radius
+# apart see each other (radius a whole number of cells, or any other
+# distance between cell centres) then depends on the tile. Cells at radius
+# are taken as visible, the cli is given a radius just past it. checkTiling
+# compares a run in several tiles with the whole plan.
+
+haloFactors = {"visibility-local": 2, None: 1}
+
+
+def visibilityReach(radius, gridSize):
+    # the maxVisibility that lets cells exactly radius apart see each other
+    # whatever the rounding of their coordinates
+    return radius + gridSize * 1e-6
+
+
+def planGraph(lineMap, graphFileOut, gridSize, fillX, fillY, cliPath):
+    # a filled grid on a plan, ready for makeVGAGraph
+    dx.importLines(lineMap, graphFileOut, cliPath)
+    dx.convertMap(graphFileOut, newMapType = "drawing", newMapName = "Plan", cliPath = cliPath)
+    dx.createGrid(graphFileOut, gridSize = gridSize, cliPath = cliPath)
+    dx.fillGrid(graphFileOut, fillX = fillX, fillY = fillY, cliPath = cliPath)
+
+
+def gridLayout(lineMap, gridSize, fillX, fillY, cliPath):
+    # the filled cells of the whole plan (Ref, i, j, x, y). Filled cells are
+    # only exported once there is a visibility graph, one limited to the
+    # next cells is cheap to make
+    with dx.workspace() as tmpDir:
+        graphFile = os.path.join(tmpDir, "layout.graph")
+        planGraph(lineMap, graphFile, gridSize, fillX, fillY, cliPath)
+        dx.makeVGAGraph(graphFile, maxVisibility = gridSize, cliPath = cliPath)
+        layout = dx.getPointmapData(graphFile, columns = [], geometry = False, cliPath = cliPath)
+    return pd.DataFrame(layout)[["Ref", "i", "j", "x", "y"]]
+
+
+def gridOrigin(layout, gridSize):
+    # the centre of cell (0, 0)
+    return (float(np.median(layout["x"] - layout["i"] * gridSize)),
+            float(np.median(layout["y"] - layout["j"] * gridSize)))
+
+
+def clipPlan(lineMap, window):
+    # the plan lines inside window, closed with the outline of the window
+    clipped = lineMap.geometry.intersection(window)
+    clipped = clipped[~clipped.is_empty]
+    clipped = clipped[clipped.geom_type.isin(["LineString", "MultiLineString"])]
+    outline = geopandas.GeoSeries([shapely.LineString(window.exterior.coords)], crs = lineMap.crs)
+    lines = pd.concat([clipped, outline], ignore_index = True)
+    return geopandas.GeoDataFrame(geometry = lines, crs = lineMap.crs)
+
+
+def tileWorker(task):
+    tileLines, fillX, fillY, core, gridSize, radius, vgaMode, cliPath = task
+    with dx.workspace() as tmpDir:
+        graphFile = os.path.join(tmpDir, "tile.graph")
+        planGraph(tileLines, graphFile, gridSize, fillX, fillY, cliPath)
+        dx.makeVGAGraph(graphFile, maxVisibility = radius, cliPath = cliPath)
+        if vgaMode is not None:
+            dx.VGA(graphFile, vgaMode = vgaMode, cliPath = cliPath)
+        result = pd.DataFrame(dx.getPointmapData(graphFile, geometry = False, cliPath = cliPath))
+    # cells on the edges belong to the tile left of and below them
+    minX, minY, maxX, maxY = core
+    inCore = (result["x"] >= minX) & (result["x"] < maxX) & (result["y"] >= minY) & (result["y"] < maxY)
+    return result[inCore].drop(columns = ["Ref", "i", "j"])
+
+
+def tiledVGA(lineMap, gridSize, fillX, fillY, radius, vgaMode = "visibility-local", tileSize = None,
+             processes = None, cliPath = None):
+    # lineMap: the plan lines (as for importLines). vgaMode None only makes
+    # the visibility graph measures (Connectivity, Point First/Second Moment).
+    # tileSize (in map units, 4 halos by default) bounds the size of the
+    # visibility graph of each process. Returns a GeoDataFrame like
+    # getPointmapData, with the Refs of the grid of the whole plan
+    if vgaMode not in haloFactors:
+        raise ValueError("Only visibility-local VGA can be tiled, not " + str(vgaMode))
+    if radius is None or radius <= 0:
+        raise ValueError("A positive visibility radius must be provided")
+    if not isinstance(fillX, list):
+        fillX = [fillX]
+    if not isinstance(fillY, list):
+        fillY = [fillY]
+
+    reach = visibilityReach(radius, gridSize)
+    layout = gridLayout(lineMap, gridSize, fillX, fillY, cliPath)
+    if len(layout) == 0:
+        raise ValueError("The fill locations don't fill any cells")
+    originX, originY = gridOrigin(layout, gridSize)
+    # a cell more, so that the wall at the edge of the halo doesn't block any cell within reach
+    halo = haloFactors[vgaMode] * radius + gridSize
+    if tileSize is None:
+        tileSize = 4 * halo
+    if tileSize < gridSize:
+        raise ValueError("The tile size must be at least the grid size")
+
+    # tiles start half a cell before a cell centre, so that no centre is on an edge
+    startX = layout["x"].min() - gridSize / 2
+    startY = layout["y"].min() - gridSize / 2
+    tileX = np.floor((layout["x"].values - startX) / tileSize).astype(np.int64)
+    tileY = np.floor((layout["y"].values - startY) / tileSize).astype(np.int64)
+    tasks = []
+    for tx, ty in sorted(set(zip(tileX.tolist(), tileY.tolist()))):
+        core = (startX + tx * tileSize, startY + ty * tileSize,
+                startX + (tx + 1) * tileSize, startY + (ty + 1) * tileSize)
+        window = shapely.box(core[0] - halo, core[1] - halo, core[2] + halo, core[3] + halo)
+        # fill the tile from every cell of the whole plan in it, keeping off the outline
+        seeds = layout[(layout["x"] > core[0] - halo + gridSize) & (layout["x"] < core[2] + halo - gridSize) &
+                       (layout["y"] > core[1] - halo + gridSize) & (layout["y"] < core[3] + halo - gridSize)]
+        tasks.append((clipPlan(lineMap, window), seeds["x"].tolist(), seeds["y"].tolist(), core,
+                      gridSize, reach, vgaMode, cliPath))
+
+    if processes is None:
+        processes = min(len(tasks), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+        results = list(executor.map(tileWorker, tasks))
+
+    # back to the cells of the whole plan by grid position
+    result = pd.concat(results, ignore_index = True)
+    i = np.rint((result["x"].values - originX) / gridSize).astype(np.int64)
+    j = np.rint((result["y"].values - originY) / gridSize).astype(np.int64)
+    result = result.set_index((i << 16) | j).drop(columns = ["x", "y"])
+    if result.index.has_duplicates:
+        raise ValueError("Tiles returned the same cell more than once")
+    measures = list(result.columns)
+    result = layout.set_index("Ref").join(result).reset_index()
+    pointMap = result[["Ref"] + measures].assign(i = result["i"], j = result["j"])
+    pointMap = geopandas.GeoDataFrame(pointMap, geometry = geopandas.points_from_xy(result["x"], result["y"]))
+    return pointMap.rename_geometry("coords")
+
+
+def checkTiling(lineMap, gridSize, fillX, fillY, radius, vgaMode = "visibility-local", tileSize = None,
+                cliPath = None):
+    # runs the plan in tiles of tileSize (as tiledVGA) and as it is, and
+    # returns the number of cells that differ for each measure (all 0 when
+    # tiling is exact). The tiles must split the plan, or there is nothing
+    # to compare
+    if not isinstance(fillX, list):
+        fillX = [fillX]
+    if not isinstance(fillY, list):
+        fillY = [fillY]
+    tiled = tiledVGA(lineMap, gridSize, fillX, fillY, radius, vgaMode, tileSize = tileSize,
+                     cliPath = cliPath)
+    if tileSize is None:
+        tileSize = 4 * (haloFactors[vgaMode] * radius + gridSize)
+    spanX = tiled.geometry.x.max() - tiled.geometry.x.min() + gridSize
+    spanY = tiled.geometry.y.max() - tiled.geometry.y.min() + gridSize
+    if spanX <= tileSize and spanY <= tileSize:
+        raise ValueError("The plan fits in one tile, check with a tile size under " +
+                         str(max(spanX, spanY)))
+    with dx.workspace() as tmpDir:
+        graphFile = os.path.join(tmpDir, "whole.graph")
+        planGraph(lineMap, graphFile, gridSize, fillX, fillY, cliPath)
+        dx.makeVGAGraph(graphFile, maxVisibility = visibilityReach(radius, gridSize), cliPath = cliPath)
+        if vgaMode is not None:
+            dx.VGA(graphFile, vgaMode = vgaMode, cliPath = cliPath)
+        whole = pd.DataFrame(dx.getPointmapData(graphFile, geometry = False, cliPath = cliPath))
+    whole = whole.set_index("Ref")
+    tiled = pd.DataFrame(tiled.drop(columns = tiled.geometry.name)).set_index("Ref")
+    if not whole.index.sort_values().equals(tiled.index.sort_values()):
+        raise ValueError("The tiles and the whole plan have different cells")
+    tiled = tiled.loc[whole.index]
+    return {measure: int((~np.isclose(whole[measure], tiled[measure], equal_nan = True)).sum())
+            for measure in tiled.columns if measure not in ["i", "j"]}